@@ -0,0 +1,215 @@
+# aiolookup.py
+#
+#
+# Concurrent per-variant lookups for the annotation stages
+#
+# A stage describes the query of each record with a lookup function;
+# lookupRows() keeps up to `concurrency` of those queries in flight on an
+# asyncio event loop and hands the rows back in input order, so stage
+# output does not change. Drivers are pluggable: "thread" runs the regular
+# blocking connections (pymysql, or any DB-API stand-in such as sqlite3) in
+# a thread pool, "aiomysql" uses a native async MySQL pool.
+#
+##
+
+import asyncio
+import threading
+import contextvars
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import time
+import utils as u
+import varcache
+import statements as st
+import instrument
+
+# Queries in flight per annotator (1 = one query at a time on the stage's
+# own cursor)
+QUERY_CONCURRENCY = 1
+
+# Name of the driver in DRIVERS used for concurrent lookups
+QUERY_DRIVER = 'thread'
+
+
+"""Runs blocking DB-API queries in a thread pool, each thread holding its
+   own connection from connect (the pooled reference database by default);
+   paramstyle='qmark' for drivers such as sqlite3
+"""
+class ThreadDriver(object):
+    def __init__(self, workers=8, connect=None, paramstyle='format'):
+        self.connect = connect or u.db_connect
+        self.paramstyle = paramstyle
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def query(self, statement, params, one=False):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            with self.lock:
+                self.connections.append(conn)
+        cursor = conn.cursor()
+        if (self.paramstyle == 'qmark'):
+            statement = statement.qmark()
+        if one:
+            return statement.fetchone(cursor, params)
+        return statement.fetchall(cursor, params)
+
+    async def fetch(self, statement, params, one=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+            contextvars.copy_context().run, self.query, statement, params, one)
+
+    async def close(self):
+        self.executor.shutdown(wait=True)
+        for conn in self.connections:
+            conn.close()
+
+
+"""Native asyncio MySQL driver (requires aiomysql)
+"""
+class AiomysqlDriver(object):
+    def __init__(self, workers=8):
+        import aiomysql
+        self.aiomysql = aiomysql
+        self.workers = workers
+        self.pool = None
+
+    async def fetch(self, statement, params, one=False):
+        if self.pool is None:
+            rds_secret = u.get_db_secret()
+            self.pool = await self.aiomysql.create_pool(
+                host=rds_secret['host'], port=rds_secret['port'],
+                user=rds_secret['username'], password=rds_secret['password'],
+                db='annotator', minsize=1, maxsize=self.workers)
+
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                start = time.perf_counter()
+                await cursor.execute(statement.sql, tuple(params))
+                if one:
+                    result = await cursor.fetchone()
+                else:
+                    result = await cursor.fetchall()
+                st.record(statement.name, time.perf_counter() - start,
+                    st.rowCount(result))
+                return result
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+
+DRIVERS = {'thread': ThreadDriver, 'aiomysql': AiomysqlDriver}
+
+
+"""Makes a driver class available under name; it is constructed with
+   workers=<concurrency> and must provide async fetch(statement, params,
+   one) and close()
+"""
+def registerDriver(name, driver):
+    DRIVERS[name] = driver
+
+
+"""Event loop running in a background thread that the (synchronous) stage
+   generators submit queries to
+"""
+class LookupEngine(object):
+    def __init__(self, concurrency, driver=None):
+        self.driver = driver or DRIVERS[QUERY_DRIVER](workers=concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+            daemon=True)
+        self.thread.start()
+
+    def submit(self, statement, params, one=False):
+        return asyncio.run_coroutine_threadsafe(self.fetch(
+            instrument.SCOPE.get(), statement, params, one), self.loop)
+
+    async def fetch(self, scope, statement, params, one):
+        # Each task runs in a copy of the loop's context: queries are
+        # counted against the stage that submitted them
+        instrument.SCOPE.set(scope)
+        return await self.driver.fetch(statement, params, one)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.driver.close(),
+            self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+"""Yields (fields, rows) for every record, in input order
+   lookup(fields) returns (statement, params, variant) for records that
+   need a query, variant being the (chrom, pos[, ref[, alt]]) key of the
+   variant cache,
+   or None (rows is then None). With concurrency > 1 up to that many
+   records are looked up ahead on a LookupEngine, started on the first
+   query (stages answered from an index never start one); cache hits are
+   resolved without a query either way. one=True fetches a single row per
+   record
+"""
+def lookupRows(records, lookup, cursor, cache, one=False, concurrency=None,
+    driver=None):
+
+    concurrency = QUERY_CONCURRENCY if concurrency is None else concurrency
+    fetch = cache.fetchone if one else cache.fetchall
+
+    if (concurrency <= 1):
+        for fields in records:
+            query = lookup(fields)
+            if query is None:
+                yield fields, None
+            else:
+                statement, params, variant = query
+                yield fields, fetch(cursor, statement, params, *variant)
+        return
+
+    engines = []
+    window = collections.deque()
+
+    def submit(statement, params):
+        if not engines:
+            engines.append(LookupEngine(concurrency, driver=driver))
+        return engines[0].submit(statement, params, one)
+
+    def resolve(entry):
+        fields, future, value, key = entry
+        if future is not None:
+            value = future.result()
+            if key is not None:
+                cache.put(key, value)
+        return fields, value
+
+    try:
+        for fields in records:
+            query = lookup(fields)
+            if query is None:
+                window.append((fields, None, None, None))
+            else:
+                statement, params, variant = query
+                key = None
+                value = varcache.MISS
+                if cache.db is not None:
+                    key = cache.key(*variant)
+                    value = cache.get(key)
+                if value is varcache.MISS:
+                    window.append((fields, submit(statement, params), None,
+                        key))
+                else:
+                    window.append((fields, None, value, None))
+
+            while (len(window) >= concurrency):
+                yield resolve(window.popleft())
+
+        while window:
+            yield resolve(window.popleft())
+    finally:
+        for engine in engines:
+            engine.close()
+
+### EOF
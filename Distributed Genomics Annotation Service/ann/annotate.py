@@ -10,11 +10,65 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import file_utils as fu
+import copy
+import string
 import utils as u
+import reference as ref
+import binning
+import transcripts
+import varcache
+import bgzf
+import instrument
+import aiolookup as aq
+import statements as st
+import mmapindex as mi
+from sweep import SweepJoin
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Annotator queries: {names} are table/column identifiers filled in by
+# statements.prepare, %s are parameters
+DBSNP_QUERY = 'select * from dbSNP where CHR=%s AND POS=%s AND ' + \
+    '(REF=%s OR REF=%s) AND INFO=%s;'
+
+DBSNP_BLOCK_QUERY = 'select POS, REF, dbSNP.* from dbSNP where CHR=%s ' + \
+    'AND POS IN ({positions}) AND INFO=%s;'
+
+BIGREFGENE_QUERY = 'select 1 as tier, t.* from chrom_pos_equal_base t ' + \
+    'where CHR=%s AND start=%s AND ((haplotypeReference=%s AND ' + \
+    'haplotypeAlternate=%s) OR (haplotypeReference=%s AND ' + \
+    'haplotypeAlternate=%s)) UNION ALL select 2 as tier, t.* from ' + \
+    'chrom_pos_equal_nobase t where CHR=%s AND start=%s UNION ALL ' + \
+    'select 3 as tier, t.* from chrom_pos_unequal t where CHR=%s AND ' + \
+    'start <= %s AND %s <= end order by tier;'
+
+REFGENE_PROMOTER_QUERY = 'select * from {table} where chrom=%s AND ' + \
+    '(txStart - %s) <= %s AND %s <= (txEnd + %s){bins};'
+
+CPG_ISLAND_QUERY = 'select chrom, chromStart, chromEnd, name from ' + \
+    '{table} where chrom=%s AND (chromStart <= %s AND %s <= chromEnd){bins};'
+
+SPLIT_OVERLAP_QUERY = 'select {columns} from {table} where {start} <= %s ' + \
+    'AND %s <= {end}{bins};'
+
+OVERLAP_QUERY = 'select {columns} from {table} where {chrom}=%s AND ' + \
+    '({start} <= %s AND %s <= {end}){bins};'
+
+POSITION_QUERY = 'select * from {table} where {chrom}=%s AND {pos}=%s;'
+
+
+"""Prepared statement of template for table, with the UCSC bin filter of
+   the position (padded by offset) in place of {bins} when the table has a
+   bin column; returns the statement and the parameters of the bin filter
+"""
+def binnedStatement(name, template, cursor, table, pos, offset=0,
+    **identifiers):
+
+    clause, bins = binning.binFilter(cursor, table, pos, offset=offset)
+    statement = st.prepare(name, template.replace('{bins}', clause),
+        table=table, **identifiers)
+    return statement, bins
+
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
         'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
@@ -107,89 +161,398 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""Header and meta-information lines are passed through by every stage
+"""
+def isHeader(fields):
+    return fields[0].startswith('#') or fields[0].startswith('CHROM')
+
+
+# Column of the INFO field
+INFO = 7
+
+
+"""INFO text as its list of annotations ('.' is empty)
+"""
+def parseInfo(text):
+    if (text == '.'):
+        return []
+    return [entry for entry in text.split(';') if entry]
+
+
+def formatInfo(entries):
+    return ';'.join(entries) if entries else '.'
+
+
+"""One line of a VCF file, split into its columns
+   The INFO column of a variant is held as an ordered list of key=value
+   annotations (or flags) that stages add with annotate(); it is only
+   joined into text when the line is written, or when a stage reads
+   record[INFO]. Stages that read earlier annotations look them up by key
+   with infoValue(), from a mapping parsed once per record. Header lines
+   keep their columns as they are
+"""
+class Record(object):
+    __slots__ = ['fields', 'info', 'values']
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.info = None
+        self.values = None
+        if (len(fields) > INFO) and not isHeader(fields):
+            self.info = parseInfo(fields[INFO])
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, i):
+        if (self.info is not None) and (i == INFO or i == INFO - len(self)):
+            return formatInfo(self.info)
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        if (self.info is not None) and (i == INFO or i == INFO - len(self)):
+            self.info = parseInfo(value)
+            self.values = None
+        else:
+            self.fields[i] = value
+
+    """Appends annotations to INFO, skipping empty ones
+    """
+    def annotate(self, *entries):
+        entries = [entry for entry in entries if entry]
+        self.info.extend(entries)
+        if self.values is not None:
+            self.addValues(entries)
+
+    """Adds annotations (each possibly holding several ';'-separated
+       entries) to the parsed mapping; the first value of a key is kept
+    """
+    def addValues(self, entries):
+        for annotation in entries:
+            for entry in annotation.split(';'):
+                key, sep, value = entry.partition('=')
+                if key and (key not in self.values):
+                    self.values[key] = value if sep else True
+
+    """Value of INFO annotation key (True for a flag), or default if the
+       record has none; keys match exactly, unlike utils.parse_field
+    """
+    def infoValue(self, key, default=None):
+        if self.info is None:
+            return default
+        if self.values is None:
+            self.values = {}
+            self.addValues(self.info)
+        return self.values.get(key, default)
+
+    def __str__(self):
+        if self.info is not None:
+            self.fields[INFO] = formatInfo(self.info)
+        return '\t'.join(self.fields)
+
+
+"""Reads a VCF file (plain, gzip or BGZF) as a stream of records
+"""
+def readRecords(filename, sep='\t'):
+    with bgzf.openText(filename) as fh:
+        for line in fh:
+            instrument.count('bytes_read', len(line))
+            yield Record(line.strip().split(sep))
+
+
+"""Writes a stream of records, one tab-separated line per record; BGZF
+   compressed if filename ends with .gz
+"""
+def writeRecords(records, filename):
+    with bgzf.openText(filename, 'w') as fh_out:
+        for record in records:
+            line = str(record) + '\n'
+            instrument.count('bytes_written', len(line))
+            fh_out.write(line)
+
+
+"""Overlap counters: table rows matched, and variants with any match
+"""
+def overlapCounts(table, var_count, line_count):
+    return {'kind': 'overlap', 'table': str(table), 'hits': var_count,
+        'variants': line_count}
+
+
+"""Formats the statistics a stage collected as .count.log lines
+"""
+def formatLog(counts):
+    if (counts['kind'] == 'dbSNP'):
+        # Total has always counted one line more than there are variants
+        total = counts['variants'] + 1
+        ratioInDbSnp = (counts['found'] / float(total)) * 100
+        return ["## Please notice that all Isoforms were counted\n",
+            "## Numbers may exceed number of variants in the annotated file\n",
+            f"Total: {str(total)}\n",
+            f"In dbSNP: {str(counts['found'])} ({str(ratioInDbSnp)}%)\n"]
+
+    if (counts['kind'] == 'located'):
+        return ["Variants located:\n",
+            f"In interGenic {str(counts['interGenic'])}\n",
+            f"In CDS {str(counts['CDS'])}\n",
+            f"In \'3 UTR {str(counts['utr3'])}\n",
+            f"In \'5 UTR {str(counts['utr5'])}\n",
+            f"In Intronic {str(counts['intronic'])}\n",
+            f"In Non_coding_intronic {str(counts['non_coding_intronic'])}\n",
+            f"In Exonic {str(counts['exonic'])}\n",
+            f"In Non_coding_exonic {str(counts['non_coding_exonic'])}\n",
+            f"In Putative Promoter Region {str(counts['promoter'])}\n"]
+
+    if (counts['kind'] == 'locatedTables'):
+        lines = ["Variants located per chromosome:\n"]
+        for chrom in sorted(counts['chroms'], key=chromOrder):
+            lines.append(formatLocated(chrom, counts['chroms'][chrom]))
+        lines.append("Variants located per gene:\n")
+        for gene in sorted(counts['genes']):
+            lines.append(formatLocated(gene, counts['genes'][gene]))
+        return lines
+
+    if (counts['kind'] == 'filtered'):
+        return [f"Filtered out: {str(counts['dropped'])} lines with " + \
+            "REF = ALT or on other chromosomes than 1-22, X, Y, MT\n"]
+
+    if (counts['kind'] == 'cache'):
+        return [f"Cache {counts['table']}: {str(counts['hits'])} hits, " + \
+            f"{str(counts['misses'])} misses\n"]
+
+    return [f"In {counts['table']}: {str(counts['hits'])} in " + \
+        f"{str(counts['variants'])} variants\n"]
+
+
+"""One row of a location table: the non-zero counters of name
+"""
+def formatLocated(name, table):
+    return name + '\t' + '\t'.join([category + '=' + str(table[category])
+        for category in LOCATED if table.get(category)]) + '\n'
+
+
+"""Sort key putting chr2 before chr10
+"""
+def chromOrder(chrom):
+    name = str(chrom).replace('chr', '')
+    return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+
+"""Adds the counters of other to counts, table by table
+"""
+def mergeCounts(counts, other):
+    for key, value in other.items():
+        if isinstance(value, dict):
+            mergeCounts(counts.setdefault(key, {}), value)
+        elif isinstance(value, int):
+            counts[key] = counts.get(key, 0) + value
+
+
+"""Adds up the statistics of runs over parts of the same input; each log
+   holds the same entries, in stage order
+"""
+def mergeLogs(logs):
+    merged = []
+    for entries in zip(*logs):
+        counts = dict([(key, value) for key, value in entries[0].items()
+            if not isinstance(value, (int, dict))])
+        for entry in entries:
+            mergeCounts(counts, entry)
+        merged.append(counts)
+    return merged
+
+
+"""Writes the statistics collected by stages to the job's .count.log
+"""
+def writeLog(basefile, log, mode='a'):
+    with open(basefile + '.count.log', mode) as fh_log:
+        for counts in log:
+            fh_log.writelines(formatLog(counts))
+
+
+"""Trims a record the same way a staged run does when it re-reads an
+   intermediate file, so fused and staged output match byte for byte
+"""
+def restrip(records, sep='\t'):
+    for record in records:
+        if record[-1][-1:].isspace():
+            record = Record(str(record).strip().split(sep))
+        yield record
+
+
+"""Runs one stage from an intermediate file to the next; source(filename,
+   log) replaces readRecords for reading it (e.g. driver.inputRecords)
+"""
+def runStage(stage, vcf, tmpextin, tmpextout, logmode='a', sep='\t',
+    source=None, **kwargs):
+
+    log = []
+    if source is None:
+        records = readRecords(vcf + tmpextin, sep=sep)
+    else:
+        records = source(vcf + tmpextin, log)
+    writeRecords(stage(records, log=log, **kwargs), vcf + tmpextout)
+    writeLog(vcf, log, mode=logmode)
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    With batch_size > 1, blocks of batch_size records are looked up with
+    one query per chromosome instead of one query per record
 """ 
 def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
+    varclass='SNV', sep='\t', batch_size=1000):
+
+    runStage(getSnpsFromDbSnpStage, vcf, tmpextin, tmpextout, logmode='w',
+        sep=sep, format=format, varclass=varclass, batch_size=batch_size)
+
+
+def getSnpsFromDbSnpStage(records, format='vcf', varclass='SNV',
+    batch_size=1000, log=None):
+
+    log = [] if log is None else log
     var_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
+    cache = varcache.VariantCache('dbSNP.' + varclass)
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
+    # A memory-mapped export of dbSNP (mmapindex.py) replaces the queries,
+    # and the variant cache, which would be slower than the index
+    index = mi.openIndex('dbSNP')
+    batched = (batch_size > 1) or index is not None
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+    for block in u.chunks(records, max(1, batch_size)):
+        if batched:
+            block_rows = getSnpsFromDbSnpBlock(cursor, block, inds, varclass,
+                cache=(cache if index is None else None), index=index)
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
+        for i, fields in enumerate(block):
+            if not isHeader(fields):
+                if batched:
+                    rows = block_rows[i]
                 else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
-
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+                    rows = getSnpsFromDbSnpRows(cursor, fields, inds, varclass,
+                        cache=cache)
 
-            else:
                 ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                fields[2] = '.'
+                rsids = []
+                mafs = []
+                if (len(rows) > 0):
+                    # Neither query orders the rows of a variant with
+                    # several rsids; sorting them makes the per-variant,
+                    # block and index lookups agree on any database plan
+                    for row in sorted(rows, key=lambda row: str(row[3])):
+                        rsids.append(str(row[3]))
+                        if (str(row[7]) != '.'):
+                            mafs.append('GMAF=' + str(row[7]))
 
-            linenum = linenum + 1
+                    var_count = var_count + 1
+                    if (len(fields.info) == 0):
+                        fields.annotate('DB', *mafs)
+                    else:
+                        fields.annotate('DB', 'VC=' + varclass, *mafs)
 
-        else:
-            fh_out.write(line + '\n')
+                    fields[2] = str(';'.join(rsids))
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+                linenum = linenum + 1
+
+            yield fields
+
+    log.append({'kind': 'dbSNP', 'variants': linenum - 1, 'found': var_count})
+    cache.close(log)
 
     conn.close()
-    fh.close()
-    fh_out.close()
+
+
+"""Chromosome, position and the reference alleles (as given and
+   complementary) a dbSNP lookup matches on
+"""
+def dbSnpKey(fields, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+
+    return chr, pos, ref, getComplementary(ref)
+
+
+"""One dbSNP round trip for a single record
+"""
+def getSnpsFromDbSnpRows(cursor, fields, inds, varclass='SNV', cache=None):
+    chr, pos, ref, compRef = dbSnpKey(fields, inds)
+
+    statement = st.prepare('dbSNP', DBSNP_QUERY)
+    params = (chr, int(pos), ref, compRef, varclass)
+    if cache is not None:
+        return cache.fetchall(cursor, statement, params, chr, int(pos), ref)
+    return statement.fetchall(cursor, params)
+
+
+"""Resolves a block of records with one set-based query per chromosome and
+   fans the rows back out: returns the matching rows for each record index
+   of the block (in no particular order). With a mapped
+   index the positions of each chromosome are looked up in it instead
+"""
+def getSnpsFromDbSnpBlock(cursor, block, inds, varclass='SNV', cache=None,
+    index=None):
+    keys = {}
+    positions = {}
+    block_rows = {}
+    for i, fields in enumerate(block):
+        if not isHeader(fields):
+            chr, pos, ref, compRef = dbSnpKey(fields, inds)
+            if cache is not None and cache.db is not None:
+                cached = cache.get(cache.key(chr, int(pos), ref))
+                if cached is not varcache.MISS:
+                    block_rows[i] = cached
+                    continue
+            keys[i] = (chr, int(pos), ref.upper(), compRef.upper())
+            positions.setdefault(chr, set()).add(int(pos))
+
+    found = {}
+    for chr, chr_positions in positions.items():
+        if index is not None:
+            found.update(getSnpsFromDbSnpIndex(index, chr,
+                sorted(chr_positions), varclass))
+            continue
+
+        # IN lists are padded to a power of two so that a few statements
+        # cover every block size
+        values = st.padded(sorted(chr_positions))
+        statement = st.prepare('dbSNP.block', DBSNP_BLOCK_QUERY.replace(
+            '{positions}', st.placeholders(len(values))))
+        for row in statement.fetchall(cursor, [chr] + values + [varclass]):
+            found.setdefault((chr, int(row[0])), []).append(row)
+
+    # REF comparison follows MySQL's case-insensitive string equality
+    for i, (chr, pos, ref, compRef) in keys.items():
+        block_rows[i] = [row[2:] for row in found.get((chr, pos), [])
+            if str(row[1]).strip().upper() in (ref, compRef)]
+        if cache is not None and cache.db is not None:
+            cache.put(cache.key(chr, pos, ref), block_rows[i])
+
+    return block_rows
+
+
+"""Rows of the mapped dbSNP index at positions of chr, keyed by (chr, pos)
+   and shaped like the rows of DBSNP_BLOCK_QUERY: POS, REF, dbSNP.*
+"""
+def getSnpsFromDbSnpIndex(index, chr, positions, varclass='SNV'):
+    p, r, c = index.column('POS'), index.column('REF'), index.column('INFO')
+    instrument.count('index_lookups', len(positions))
+    found = {}
+    for pos, rows in zip(positions, index.findMany(chr, positions)):
+        for row in rows:
+            # INFO=%s compares case-insensitively in MySQL
+            if (str(row[c]).upper() == varclass.upper()):
+                found.setdefault((chr, pos), []).append([row[p], row[r]] + \
+                    row)
+    return found
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -198,307 +561,270 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     3. chrom_pos_unequal
 """
 def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    runStage(getBigRefGeneStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format)
+
+
+def getBigRefGeneStage(records, format='vcf', concurrency=None, log=None):
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
 
     conn = u.db_connect()
     cursor = conn.cursor()
+    cache = varcache.VariantCache('bigRefGene')
     vcf_linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    lookups = aq.lookupRows(records, lambda fields: bigRefGeneQuery(fields,
+        inds), cursor, cache, concurrency=concurrency)
 
+    for fields, rows in lookups:
+        if not isHeader(fields):
             if (len(rows) > 0):
-                keep_going = False
+                tier = rows[0][0]
                 m = set([])
                 for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
+                    if (row[0] != tier):
+                        break
+                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[2:len(row)]])))
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+                fields.annotate(*m)
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+            vcf_linenum = vcf_linenum + 1
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+        yield fields
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    cache.close(log)
+    conn.close()
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+"""Query of the BigRefGene tiers for a record, with its cache key
+"""
+def bigRefGeneQuery(fields, inds):
+    if isHeader(fields):
+        return None
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+    pos = fields[inds[1]].strip()
+    ref = clean_mysql_chars(fields[inds[2]]).strip()
+    alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            vcf_linenum = vcf_linenum + 1
+    compRef = getComplementary(ref)
+    compAlt = getComplementary(alt)
 
-        else:
-            fh_out.write(line + '\n')
+    # The three tiers are tried in one round trip; rows come back
+    # ordered by tier and only the first tier that matched is used
+    statement = st.prepare('bigRefGene', BIGREFGENE_QUERY)
+    params = (chr, int(pos), ref, alt, compRef, compAlt, chr, int(pos), chr,
+        int(pos), int(pos))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return statement, params, (chr, int(pos), ref, alt)
 
 
 """Get information about location in gene structures
 """
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    runStage(getGenesStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, promoter_offset=promoter_offset)
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
+
+def getGenesStage(records, format='vcf', table='refGene', promoter_offset=500,
+    concurrency=None, log=None):
+
+    log = [] if log is None else log
+    counts = LocatedCounts()
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
+    cache = varcache.VariantCache(table + '.promoter' + str(promoter_offset))
 
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
+    lookups = aq.lookupRows(records, lambda fields: refGeneQuery(fields, inds,
+        cursor, table, promoter_offset), cursor, cache,
+        concurrency=concurrency)
 
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
+    for fields, rows in lookups:
+        if not isHeader(fields):
+            fields.annotate(*getGenesRegions(fields, rows, inds, cursor,
+                promoter_offset, counts))
+        yield fields
 
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+    entries = counts.entries()
+    for line in formatLog(entries[0]):
+        print(line.rstrip('\n'))
+    log.extend(entries)
+    cache.close(log)
 
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+    conn.close()
+    transcripts.save()
 
-                    else:
-                        region = ''
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+"""Chromosome (with chr prefix) and position of a record, and the location
+   category of the positionType annotation (BigRefGene) it carries
+"""
+def getGenesLocus(fields, inds):
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+
+    positionType = fields.infoValue('positionType')
+    if isinstance(positionType, str):
+        positionType = clean_mysql_chars(positionType)
+    return chr, int(fields[inds[1]].strip()), POSITION_TYPES.get(positionType)
+
+
+def exonLabels(row, exons, label):
+    exonCount = int(row[8])
+    strand = str(row[3])
+    labels = []
+    for e in exons:
+        exnum = e + 1
+        if (strand == '-'):
+            exnum = exonCount - e
+        labels.append(label + "ex" + str(exnum) + '/' + str(exonCount))
+    return labels
+
+
+"""putativePromoterRegion annotation of pos, if a CpG island overlaps it
+"""
+def promoterRegion(cursor, chr, pos, counts, gene):
+    island = cpgIsland(cursor, chr, pos)
+    if (island is None):
+        return ''
+    counts.add('promoter', chr, gene)
+    return 'putativePromoterRegion=' + "".join(str(island[3]).split())
 
-                    cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+"""INFO annotations of one record from its refGene rows, one row at a time
+"""
+def getGenesRegions(fields, rows, inds, cursor, promoter_offset, counts):
+    chr, pos, category = getGenesLocus(fields, inds)
+    if (len(rows) == 0):
+        counts.add('interGenic', chr)
+        return ['positionType=interGenic']
+
+    info = []
+    cnt = 1
+    for row in rows:
+        gene = str(row[12]).strip()
+        #count location
+        if category is not None:
+            counts.add(category, chr, gene)
+
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        transcript = transcripts.getTranscript(row)
+        strand = str(row[3])
+
+        promoter_plus = txtStart - int(promoter_offset)
+        promoter_minus = txtEnd + int(promoter_offset)
+        region = ""
+
+        if (cdsStart == cdsEnd):
+            region = ";".join(exonLabels(row, transcript.exonsAt(pos),
+                "non_coding_exon="))
+        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+            exons = exonLabels(row, transcript.exonsAt(pos), "exon=")
+            counts.add('exonic', chr, gene, len(exons))
+            region = ";".join(exons)
+        elif (u.isBetween(pos, promoter_plus, txtStart) and
+            (strand == "+")):
+            region = promoterRegion(cursor, chr, pos, counts, gene)
+        elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+            region = promoterRegion(cursor, chr, pos, counts, gene)
+
+        if (region != ''):
+            info.append(collapseGeneNames(row=row, indices=indicesKnownGenes,
+                region=region, cnt=cnt))
+
+        cnt = cnt + 1
+
+    return info
+
+
+"""refGene query of getGenes and getExonsEtAl for a record, with its cache
+   key: transcripts within promoter_offset of the position
+"""
+def refGeneQuery(fields, inds, cursor, table='refGene', promoter_offset=500):
+    if isHeader(fields):
+        return None
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+    chr = fields[inds[0]].strip()
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
 
-            linenum = linenum + 1
+    pos = fields[inds[1]].strip()
 
-        else:
-            fh_out.write(line + '\n')
+    statement, bins = binnedStatement('refGene.promoter',
+        REFGENE_PROMOTER_QUERY, cursor, table, pos, offset=promoter_offset)
+    params = [chr, int(promoter_offset), int(pos), int(pos),
+        int(promoter_offset)] + bins
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    return statement, params, (chr, int(pos))
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+"""CpG island overlapping a putative promoter position, or None
+"""
+def cpgIsland(cursor, chr, pos):
+    statement, bins = binnedStatement('cpgIslandExt', CPG_ISLAND_QUERY,
+        cursor, 'cpgIslandExt', pos)
+    return statement.fetchone(cursor, [chr, int(pos), int(pos)] + bins)
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+"""Location counters of getGenes and getExonsEtAl
+"""
+def locatedCounts(interGenic_count, cds_count, utr3_count, utr5_count,
+    intronic_count, non_coding_intronic_count, exonic_count,
+    non_coding_exonic_count, promoter_count):
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    return {'kind': 'located', 'interGenic': interGenic_count,
+        'CDS': cds_count, 'utr3': utr3_count, 'utr5': utr5_count,
+        'intronic': intronic_count,
+        'non_coding_intronic': non_coding_intronic_count,
+        'exonic': exonic_count, 'non_coding_exonic': non_coding_exonic_count,
+        'promoter': promoter_count}
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+# Location categories of getGenes, in .count.log order
+LOCATED = ['interGenic', 'CDS', 'utr3', 'utr5', 'intronic',
+    'non_coding_intronic', 'exonic', 'non_coding_exonic', 'promoter']
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+# Categories of the positionType annotations (BigRefGene) getGenes counts
+POSITION_TYPES = {'intron': 'intronic', 'non_coding_intron':
+    'non_coding_intronic', 'CDS': 'CDS', 'non_coding_exon':
+    'non_coding_exonic', 'utr5': 'utr5', 'utr3': 'utr3'}
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+"""Location counters of getGenes: the totals of locatedCounts, and the
+   same counters per chromosome and per gene (name2)
+"""
+class LocatedCounts(object):
+    def __init__(self):
+        self.totals = dict.fromkeys(LOCATED, 0)
+        self.chroms = {}
+        self.genes = {}
+
+    def add(self, category, chrom, gene=None, n=1):
+        if (n == 0):
+            return
+        self.totals[category] = self.totals[category] + n
+        table = self.chroms.setdefault(chrom, {})
+        table[category] = table.get(category, 0) + n
+        if gene is not None:
+            table = self.genes.setdefault(gene, {})
+            table[category] = table.get(category, 0) + n
+
+    """Log entries: the totals, then the tables
+    """
+    def entries(self):
+        return [dict({'kind': 'located'}, **self.totals),
+            {'kind': 'locatedTables', 'chroms': self.chroms,
+            'genes': self.genes}]
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -506,13 +832,14 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
 def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+    runStage(getExonsEtAlStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, promoter_offset=promoter_offset)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+
+def getExonsEtAlStage(records, format='vcf', table='refGene',
+    promoter_offset=500, concurrency=None, log=None):
+
+    log = [] if log is None else log
 
     interGenic_count = 0
     cds_count = 0
@@ -525,32 +852,23 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     promoter_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
+    cache = varcache.VariantCache(table + '.promoter' + str(promoter_offset))
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
+    lookups = aq.lookupRows(records, lambda fields: refGeneQuery(fields, inds,
+        cursor, table, promoter_offset), cursor, cache,
+        concurrency=concurrency)
+
+    for fields, rows in lookups:
+        if not isHeader(fields):
             chr = fields[inds[0]].strip()
             
             if not chr.startswith("chr"):
                 chr = "chr" + chr
             
             pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
             info = []
             if (len(rows) > 0):
                 cnt = 1
@@ -560,9 +878,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
+                    transcript = transcripts.getTranscript(row)
                     strand = str(row[3])
 
                     promoter_plus = txtStart - int(promoter_offset)
@@ -570,18 +886,15 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for e in transcript.exonsAt(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum =  exonCount - e
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
                             region='positionType=non_coding_exon;' + ";".join(exons)
                         else:
@@ -590,14 +903,13 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
+                        for e in transcript.exonsAt(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum =  exonCount - e
+                            exons.append("exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count=exonic_count+1
                         if (len(exons) > 0):
                             region = 'positionType=CDS;' + ";".join(exons)
                         else:
@@ -610,12 +922,12 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         region = 'positionType=utr5'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
+                        (cdsStart < cdsEnd) and (strand == "+")):
                         utr3_count = utr3_count + 1
                         region = 'positionType=utr3'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
+                        (cdsStart < cdsEnd) and (strand == "-")):
                         utr5_count = utr5_count + 1
                         region = 'positionType=utr5'
 
@@ -626,30 +938,20 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
+                        island = cpgIsland(cursor, chr, pos)
+
+                        if (island is not None):
                             region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
+                                "".join(str(island[3]).split())
                             promoter_count = promoter_count + 1
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
+                        island = cpgIsland(cursor, chr, pos)
+
+                        if (island is not None):
                             region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
+                            "".join(str(island[3]).split())
                             promoter_count = promoter_count + 1
 
                     else:
@@ -662,450 +964,484 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     cnt = cnt + 1
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                fields.annotate(*info)
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                fields.annotate('positionType=interGenic')
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
-        else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        yield fields
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    counts = locatedCounts(interGenic_count, cds_count, utr3_count,
+        utr5_count, intronic_count, non_coding_intronic_count, exonic_count,
+        non_coding_exonic_count, promoter_count)
+    for line in formatLog(counts):
+        print(line.rstrip('\n'))
+    log.append(counts)
+    cache.close(log)
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    conn.close()
+    transcripts.save()
+
+
+"""Declarative description of a region annotator: the reference table it
+   overlaps variants with, how the variant chromosome is matched, and the
+   INFO annotations written for the matching rows
+   entry is formatted once per row, with {0}, {1}, ... the row columns and
+   {table} the table name. Options:
+     chromCol     column of the chromosome; None for tables split per
+                  chromosome (named table + chromosome number)
+     chrPrefix    whether chromosomes are stored as "chr1" or as "1"
+     chroms       chromosome numbers that have a table (split tables)
+     startCol,    interval columns; a single column (startCol == endCol)
+     endCol       matches positions exactly
+     columns      columns selected (split tables, sweep-joins)
+     first        only the first matching row is annotated
+     binned       queries add the UCSC bin filter (binning.py)
+     preload      the table may be held in memory (reference.py)
+     mapped       a memory-mapped export of the table is used if one
+                  exists (mmapindex.py)
+     strip        strip whitespace around the value of each entry
+     dedup        drop repeated entries
+     join, prefix all entries are joined with join into one annotation
+                  (';' in values replaced by join), preceded by prefix
+     name         statement and variant cache name
+     label        name of the table in the .count.log
+"""
+class RegionAnnotator(object):
+    def __init__(self, table, entry, chromCol='chrom', chrPrefix=True,
+        chroms=None, startCol='chromStart', endCol='chromEnd', columns='*',
+        first=False, binned=False, preload=False, mapped=False, strip=False,
+        dedup=False, join=None, prefix='', name='{table}', label='{table}'):
+
+        self.table = table
+        self.entry = entry
+        self.chromCol = chromCol
+        self.chrPrefix = chrPrefix
+        self.chroms = chroms
+        self.startCol = startCol
+        self.endCol = endCol
+        self.columns = columns
+        self.first = first
+        self.binned = binned
+        self.preload = preload
+        self.mapped = mapped
+        self.strip = strip
+        self.dedup = dedup
+        self.join = join
+        self.prefix = prefix
+        self.name = name
+        self.label = label
+
+    """Chromosome (as stored in the table) and position of a record, or
+       (None, None) if the chromosome has no table
+    """
+    def locus(self, fields, inds):
+        chr = fields[inds[0]].strip()
+        if self.chrPrefix and not chr.startswith("chr"):
+            chr = "chr" + chr
+        elif not self.chrPrefix and chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+
+        if (self.chroms is not None) and \
+            (chr.replace('chr', '') not in self.chroms):
+            return None, None
+        return chr, int(fields[inds[1]].strip())
+
+    def chromTable(self, table, chr):
+        return table + chr.replace('chr', '')
+
+    """Statement and parameters of the rows overlapping chr:pos
+    """
+    def query(self, cursor, table, chr, pos):
+        name = self.name.format(table=table)
+        if self.chromCol is None:
+            statement, bins = binnedStatement(name, SPLIT_OVERLAP_QUERY,
+                cursor, self.chromTable(table, chr), pos,
+                columns=self.columns, start=self.startCol, end=self.endCol)
+            return statement, [pos, pos] + bins
+
+        if (self.startCol == self.endCol):
+            statement = st.prepare(name, POSITION_QUERY, table=table,
+                chrom=self.chromCol, pos=self.startCol)
+            return statement, [chr, pos]
+
+        if self.binned:
+            statement, bins = binnedStatement(name, OVERLAP_QUERY, cursor,
+                table, pos, columns=self.columns, chrom=self.chromCol,
+                start=self.startCol, end=self.endCol)
+            return statement, [chr, pos, pos] + bins
+
+        statement = st.prepare(name, OVERLAP_QUERY.replace('{bins}', ''),
+            table=table, columns=self.columns, chrom=self.chromCol,
+            start=self.startCol, end=self.endCol)
+        return statement, [chr, pos, pos]
+
+    """In-memory index of table (reference.py), or None
+    """
+    def preloadIndex(self, cursor, table):
+        if (self.startCol == self.endCol):
+            return ref.getPositionIndex(cursor, table, chromCol=self.chromCol,
+                posCol=self.startCol)
+        return ref.getIntervalIndex(cursor, table, chromCol=self.chromCol,
+            startCol=self.startCol, endCol=self.endCol)
+
+    def sweepJoin(self, cursor, table):
+        if self.chromCol is None:
+            return SweepJoin(cursor,
+                lambda chrom: self.chromTable(table, chrom), chromCol=None,
+                startCol=self.startCol, endCol=self.endCol,
+                columns=self.columns)
+        return SweepJoin(cursor, table, chromCol=self.chromCol,
+            startCol=self.startCol, endCol=self.endCol, columns=self.columns)
+
+    """INFO annotations of the matching rows
+    """
+    def entries(self, rows, table):
+        entries = [self.entry.format(*[str(x) for x in row], table=table)
+            for row in rows]
+        if self.strip:
+            entries = [key + sep + value.strip() for key, sep, value in
+                [entry.partition('=') for entry in entries]]
+        if self.dedup:
+            entries = u.dedup(entries)
+        if self.join is not None:
+            return [self.prefix.format(table=table) + \
+                self.join.join(entries).replace(';', self.join)]
+        return entries
+
+
+REGION_ANNOTATORS = {}
+
+# CNV databases, overlapped in one pass by multiRegionStage
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+
+"""Adds a region annotator to REGION_ANNOTATORS under the given name, e.g.
+   registerRegionAnnotator('rmsk', 'rmsk', 'repeat={10}', binned=True)
+   makes regionStage(records, 'rmsk') annotate repeats
+"""
+def registerRegionAnnotator(annotator, table, entry, **options):
+    REGION_ANNOTATORS[annotator] = RegionAnnotator(table, entry, **options)
+
+
+registerRegionAnnotator('tfbsConsSites', 'tfbsConsSites',
+    'tfbsRegion={3}.{0}.{1}.{2}', chromCol=None,
+    chroms=[str(c) for c in range(1, 23)] + ['X', 'Y'],
+    columns='chrom, chromStart, chromEnd, name', binned=True, mapped=True,
+    strip=True)
+registerRegionAnnotator('gadAll', 'gadAll', '{table}={3}',
+    chromCol='chromosome', chrPrefix=False, preload=True, dedup=True)
+registerRegionAnnotator('gwasCatalog', 'gwasCatalog',
+    '{table}=pubMedID={5},trait={10}', startCol='chromEnd', preload=True)
+registerRegionAnnotator('hugo', 'hugo', 'HGNC_GeneAnnotation={5},{6}',
+    preload=True, strip=True, dedup=True, join=',')
+registerRegionAnnotator('genomicSuperDups', 'genomicSuperDups',
+    '{table}=True;otherChrom={7};otherStart={8};otherEnd={9}', first=True,
+    binned=True)
+registerRegionAnnotator('refGene', 'refGene', 'name2={12};name={1}',
+    startCol='txStart', endCol='txEnd', name='{table}.overlap')
+registerRegionAnnotator('cytoBand', 'cytoBand', '{3}', preload=True,
+    dedup=True, join=';', prefix='{table}=')
+for table in CNV_TABLES:
+    registerRegionAnnotator(table, table, '{table}=True', first=True,
+        binned=True, preload=True)
+registerRegionAnnotator('targetScanS', 'targetScanS',
+    'miRNAsites={4},{1}_{2}_{3}', first=True, preload=True, strip=True,
+    label='miRNAsites')
+
+
+"""Overlap engine shared by all region annotators
+   Annotates each variant with the rows of the annotator's table (or of
+   table, if given) that overlap its position. Rows come from the
+   memory-mapped export of the table (mmapindex.py) for mapped annotators,
+   from the in-memory index when the annotator allows preloading and
+   preload is set, from a sweep-join with sweep=True, and otherwise from
+   one query per variant (cached, with up to concurrency queries in
+   flight)
+"""
+def regionStage(records, annotator, format='vcf', table=None, preload=True,
+    sweep=False, concurrency=None, log=None):
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    if not isinstance(annotator, RegionAnnotator):
+        annotator = REGION_ANNOTATORS[annotator]
+    table = table or annotator.table
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+    log = [] if log is None else log
+    var_count = 0
+    line_count = 0
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    inds = getFormatSpecificIndices(format=format)
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cache = varcache.VariantCache(annotator.name.format(table=table))
+    index = None
+    if annotator.mapped:
+        index = mi.openIndex(table)
+    if index is None and preload and annotator.preload:
+        index = annotator.preloadIndex(cursor, table)
+    if index is None and sweep:
+        index = annotator.sweepJoin(cursor, table)
+
+    def lookup(fields):
+        if isHeader(fields) or index is not None:
+            return None
+        chr, pos = annotator.locus(fields, inds)
+        if chr is None:
+            return None
+        statement, params = annotator.query(cursor, table, chr, pos)
+        return statement, params, (chr, pos)
+
+    lookups = aq.lookupRows(records, lookup, cursor, cache,
+        one=annotator.first, concurrency=concurrency)
+    mapped = isinstance(index, mi.MappedIndex)
+    if mapped:
+        lookups = mappedRows(index, annotator, lookups, inds)
+
+    for fields, rows in lookups:
+        if not isHeader(fields):
+            chr, pos = annotator.locus(fields, inds)
+            if chr is not None:
+                if index is not None and not mapped:
+                    rows = index.find(chr, pos)
+                elif annotator.first:
+                    rows = [] if rows is None else [rows]
+                if annotator.first:
+                    rows = rows[:1]
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+                if (len(rows) > 0):
+                    line_count = line_count + 1
+                    var_count = var_count + len(rows)
+                    fields.annotate(*annotator.entries(rows, table))
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        yield fields
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    log.append(overlapCounts(annotator.label.format(table=table), var_count,
+        line_count))
+    cache.close(log)
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
     conn.close()
 
 
-"""Overlap with tfbsConsSites
+"""(record, rows) pairs of lookups with the rows of the mapped index at the
+   locus of each record, looked up block_size records at a time with one
+   findMany per chromosome
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def mappedRows(index, annotator, lookups, inds, block_size=1000):
+    for block in u.chunks(lookups, block_size):
+        loci = [None if isHeader(fields) else annotator.locus(fields, inds)
+            for fields, rows in block]
+        positions = {}
+        for locus in loci:
+            if locus is not None and locus[0] is not None:
+                positions.setdefault(locus[0], set()).add(locus[1])
+
+        found = {}
+        for chr, chrPositions in positions.items():
+            chrPositions = sorted(chrPositions)
+            for pos, rows in zip(chrPositions, index.findMany(chr,
+                chrPositions)):
+                found[(chr, pos)] = rows
+
+        for (fields, rows), locus in zip(block, loci):
+            yield fields, found.get(locus, rows)
+
+
+"""Whether the entries of annotator use the columns of the matching rows
+   (and not only their number)
+"""
+def usesRows(annotator):
+    return any([field not in (None, 'table') for text, field, spec, conv
+        in string.Formatter().parse(annotator.entry + annotator.prefix)])
+
+
+"""Overlap engine for several region tables in one pass, e.g. the CNV
+   databases (CNV_TABLES): each variant is annotated by every annotator in
+   turn, as a chain of regionStage calls would. Rows come from one merged
+   in-memory index over all the tables when every annotator allows
+   preloading and they share their interval columns, from one sweep-join
+   per table with sweep=True, and otherwise from a single query per
+   variant covering every table. That query only returns whether (first)
+   or how often each table overlaps the variant, so it needs annotators
+   whose entries use no row columns, like '{table}=True'
+"""
+def multiRegionStage(records, annotators, format='vcf', preload=True,
+    sweep=False, concurrency=None, log=None):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    annotators = [annotator if isinstance(annotator, RegionAnnotator)
+        else REGION_ANNOTATORS[annotator] for annotator in annotators]
+    tables = [annotator.table for annotator in annotators]
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    log = [] if log is None else log
+    var_counts = [0] * len(annotators)
+    line_counts = [0] * len(annotators)
 
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    name = '+'.join([annotator.name.format(table=annotator.table)
+        for annotator in annotators])
+    cache = varcache.VariantCache(name)
+
+    merged = None
+    joins = None
+    shapes = set([(a.chromCol, a.chrPrefix, a.chroms and tuple(a.chroms),
+        a.startCol, a.endCol) for a in annotators])
+    if preload and all([a.preload for a in annotators]) and \
+        (len(shapes) == 1) and (annotators[0].chromCol is not None) and \
+        (annotators[0].startCol != annotators[0].endCol):
+        first = annotators[0]
+        merged = ref.getMergedIntervalIndex(cursor, tables,
+            chromCol=first.chromCol, startCol=first.startCol,
+            endCol=first.endCol)
+    if merged is None and sweep:
+        joins = [annotator.sweepJoin(cursor, annotator.table)
+            for annotator in annotators]
+    if merged is None and joins is None:
+        for annotator in annotators:
+            if usesRows(annotator):
+                raise ValueError(f"multiRegionStage: {annotator.table} " + \
+                    "entries need rows, which the combined query does " + \
+                    "not return")
+
+    def lookup(fields):
+        if isHeader(fields) or merged is not None or joins is not None:
+            return None
+        parts = []
+        params = []
+        for i, annotator in enumerate(annotators):
+            chr, pos = annotator.locus(fields, inds)
+            if chr is None:
+                parts.append('0')
+                continue
+            statement, values = annotator.query(cursor, annotator.table,
+                chr, pos)
+            sql = statement.sql.rstrip().rstrip(';')
+            parts.append(f"exists({sql})" if annotator.first else
+                f"(select count(*) from ({sql}) t{i})")
+            params.extend(values)
+        statement = st.prepare(name, 'select ' + ', '.join(parts) + ';')
+        return statement, params, (fields[inds[0]].strip(),
+            int(fields[inds[1]].strip()))
+
+    lookups = aq.lookupRows(records, lookup, cursor, cache, one=True,
+        concurrency=concurrency)
+
+    for fields, found in lookups:
+        if not isHeader(fields):
+            if merged is not None:
+                chr, pos = annotators[0].locus(fields, inds)
+                held = [] if chr is None else merged.find(chr, pos)
+
+            for i, annotator in enumerate(annotators):
+                chr, pos = annotator.locus(fields, inds)
+                if chr is None:
+                    continue
+                if merged is not None:
+                    rows = [row for t, row in held if t == i]
+                elif joins is not None:
+                    rows = joins[i].find(chr, pos)
+                else:
+                    rows = [()] * int(found[i])
+                if annotator.first:
+                    rows = rows[:1]
 
                 if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
+                    line_counts[i] = line_counts[i] + 1
+                    var_counts[i] = var_counts[i] + len(rows)
+                    fields.annotate(*annotator.entries(rows,
+                        annotator.table))
 
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
+        yield fields
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+    for i, annotator in enumerate(annotators):
+        log.append(overlapCounts(annotator.label.format(
+            table=annotator.table), var_counts[i], line_counts[i]))
+    cache.close(log)
 
-                    fh_out.write('\t'.join(fields) + '\n')
+    conn.close()
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+"""Overlap with tfbsConsSites
+"""
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-        linenum = linenum + 1
+    runStage(addOverlapWithTfbsConsSitesStage, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSitesStage(records, format='vcf',
+    table='tfbsConsSites', sweep=False, concurrency=None, log=None):
+
+    return regionStage(records, 'tfbsConsSites', format=format, table=table,
+        sweep=sweep, concurrency=concurrency, log=log)
 
 
 """Overlap with GadAll table
 """
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
     tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    runStage(addOverlapWithGadAllStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGadAllStage(records, format='vcf', table='gadAll',
+    preload=True, sweep=False, concurrency=None, log=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'gadAll', format=format, table=table,
+        preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
 
 """ Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+    runStage(addOverlapWithGwasCatalogStage, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGwasCatalogStage(records, format='vcf', table='gwasCatalog',
+    preload=True, sweep=False, concurrency=None, log=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'gwasCatalog', format=format, table=table,
+        preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
+    runStage(addOverlapWitHUGOGeneNomenclatureStage, vcf, tmpextin,
+        tmpextout, sep=sep, format=format, table=table)
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+def addOverlapWitHUGOGeneNomenclatureStage(records, format='vcf',
+    table='hugo', preload=True, sweep=False, concurrency=None, log=None):
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'hugo', format=format, table=table,
+        preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
 def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
     table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
 
-                fh_out.write('\t'.join(fields) + '\n')
+    runStage(addOverlapWithGenomicSuperDupsStage, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGenomicSuperDupsStage(records, format='vcf',
+    table='genomicSuperDups', sweep=False, concurrency=None, log=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'genomicSuperDups', format=format,
+        table=table, sweep=sweep, concurrency=concurrency, log=log)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
@@ -1113,291 +1449,77 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
 """
 def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+    runStage(addOverlapWithRefGeneStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+def addOverlapWithRefGeneStage(records, format='vcf', table='refGene',
+    sweep=False, concurrency=None, log=None):
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'refGene', format=format, table=table,
+        sweep=sweep, concurrency=concurrency, log=log)
 
 
 """Method to find overlap with Cytoband table
 """
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+    runStage(addOverlapWithCytobandStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCytobandStage(records, format='vcf', table='cytoBand',
+    preload=True, sweep=False, concurrency=None, log=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'cytoBand', format=format, table=table,
+        preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
 
-"""Method to find overlap with CNV tables
+"""Method to find overlap with CNV tables; table may be a list of tables
+   (e.g. CNV_TABLES), all overlapped in one pass
 """
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    runStage(addOverlapWithCnvDatabaseStage, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+def addOverlapWithCnvDatabaseStage(records, format='vcf', table='dgv_Cnv',
+    preload=True, sweep=False, concurrency=None, log=None):
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    if isinstance(table, str):
+        return regionStage(records, 'dgv_Cnv', format=format, table=table,
+            preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    # A list of tables is overlapped in one pass, each table with its own
+    # annotator, or as dgv_Cnv if it has none
+    annotators = []
+    for name in table:
+        annotator = REGION_ANNOTATORS.get(name)
+        if annotator is None:
+            annotator = copy.copy(REGION_ANNOTATORS['dgv_Cnv'])
+            annotator.table = name
+        annotators.append(annotator)
+    return multiRegionStage(records, annotators, format=format,
+        preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
 
 """Method to find overlap with targetScanS tables
 """
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+    runStage(addOverlapWithMiRNAStage, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithMiRNAStage(records, format='vcf', table='targetScanS',
+    preload=True, sweep=False, concurrency=None, log=None):
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return regionStage(records, 'targetScanS', format=format, table=table,
+        preload=preload, sweep=sweep, concurrency=concurrency, log=log)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,477 @@
+# benchmark.py
+#
+#
+# Offline annotation benchmark
+#
+# Builds a local SQLite fixture of the annotator tables (dbSNP, the
+# bigRefGene tiers, refGene, cpgIslandExt, cytoBand, the region tables) and
+# synthetic VCFs of a given size and variant mix, then times every stage of
+# driver.STAGES (and the other annotators, OTHER_STAGES) on its own and
+# driver.run end to end, reporting variants per second. Fixture and VCF
+# are generated from fixed seeds, so results of runs with the same options
+# can be compared across commits:
+#
+#   python benchmark.py --variants 20000 --output bench.json
+#   python benchmark.py --variants 20000 --compare bench.json
+#
+# No AWS access or MySQL server is needed; utils.DB_CONNECT points the
+# connection pool at the fixture.
+#
+##
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import utils as u
+import binning
+import reference as ref
+import transcripts
+import varcache
+import annotate as ann
+import driver
+
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ['X', 'Y']
+BASES = 'ACGT'
+
+CNV_TABLES = ann.CNV_TABLES
+
+# Annotators of annotate.py that are not stages of driver.STAGES, timed
+# alongside them
+OTHER_STAGES = [('getExonsEtAl', ann.getExonsEtAlStage, {}),
+    ('addOverlapWithRefGene', ann.addOverlapWithRefGeneStage, {})]
+
+BIGREFGENE_COLUMNS = ['bin', 'CHR', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+SCHEMA = {
+    'dbSNP': 'CHR, POS INT, REF, RSID, ALT, QUAL, INFO, GMAF',
+    'refGene': 'bin INT, name, chrom, strand, txStart INT, txEnd INT, ' + \
+        'cdsStart INT, cdsEnd INT, exonCount INT, exonStarts, exonEnds, ' + \
+        'score INT, name2, cdsStartStat, cdsEndStat, exonFrames',
+    'cpgIslandExt': 'bin INT, chrom, chromStart INT, chromEnd INT, name',
+    'cytoBand': 'chrom, chromStart INT, chromEnd INT, name, gieStain',
+    'gadAll': 'chromosome, chromStart INT, chromEnd INT, geneSymbol',
+    'gwasCatalog': 'bin INT, chrom, chromStart INT, chromEnd INT, name, ' + \
+        'pubMedID, author, pubDate, journal, title, trait',
+    'hugo': 'bin INT, chrom, chromStart INT, chromEnd INT, name, symbol, ' + \
+        'descr',
+    'genomicSuperDups': 'bin INT, chrom, chromStart INT, chromEnd INT, ' + \
+        'name, score, strand, otherChrom, otherStart INT, otherEnd INT',
+    'targetScanS': 'bin INT, chrom, chromStart INT, chromEnd INT, name, ' + \
+        'score INT, strand',
+}
+for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+    'chrom_pos_unequal']:
+    SCHEMA[table] = ', '.join(BIGREFGENE_COLUMNS).replace('start,',
+        'start INT,').replace('end,', 'end INT,')
+for table in CNV_TABLES:
+    SCHEMA[table] = 'bin INT, chrom, chromStart INT, chromEnd INT, name'
+for chrom in CHROMOSOMES:
+    SCHEMA['tfbsConsSites' + chrom] = 'bin INT, chrom, chromStart INT, ' + \
+        'chromEnd INT, name, score INT'
+
+INDEXES = [('dbSNP', 'CHR, POS'), ('refGene', 'chrom, bin'),
+    ('cpgIslandExt', 'chrom, bin'), ('gwasCatalog', 'chrom, chromEnd'),
+    ('genomicSuperDups', 'chrom, bin'), ('chrom_pos_equal_base', 'CHR, start'),
+    ('chrom_pos_equal_nobase', 'CHR, start'),
+    ('chrom_pos_unequal', 'CHR, start')] + \
+    [(table, 'chrom, bin') for table in CNV_TABLES] + \
+    [('tfbsConsSites' + chrom, 'bin') for chrom in CHROMOSOMES]
+
+
+"""DB-API cursor over sqlite3 taking the %s placeholders of the pymysql
+   statements
+"""
+class SqliteCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor.execute(sql.replace('%s', '?'), tuple(params))
+
+    def fetchall(self):
+        return tuple(self.cursor.fetchall())
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return tuple(self.cursor.fetchmany(size))
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Connection to the SQLite fixture, usable as utils.DB_CONNECT
+"""
+class SqliteConnection(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def ping(self, reconnect=True):
+        pass
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+def insert(db, table, rows):
+    if rows:
+        db.executemany('INSERT INTO ' + table + ' VALUES (' + \
+            ','.join(['?'] * len(rows[0])) + ');', rows)
+
+
+"""Fills the SQLite file path with random reference tables: scale rows of
+   each kind per chromosome of length bases
+"""
+def buildFixture(path, scale=50, length=1000000, seed=1):
+    if os.path.exists(path):
+        os.unlink(path)
+    rnd = random.Random(seed)
+    db = sqlite3.connect(path)
+    for table, columns in SCHEMA.items():
+        db.execute('CREATE TABLE ' + table + ' (' + columns + ');')
+
+    def interval(size):
+        start = rnd.randint(1, length)
+        return start, start + rnd.randint(0, size)
+
+    for chrom in CHROMOSOMES:
+        chr = 'chr' + chrom
+        rows = {}
+
+        rows['dbSNP'] = [(chrom, rnd.randint(1, length), rnd.choice(BASES),
+            'rs' + str(rnd.randint(1, 10 ** 8)), rnd.choice(BASES), '.',
+            rnd.choice(['SNV', 'SNV', 'SNV', 'DIV']),
+            rnd.choice(['.', '0.0' + str(rnd.randint(1, 9))]))
+            for i in range(scale * 4)]
+
+        for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase']:
+            rows[table] = []
+            for i in range(scale):
+                pos = rnd.randint(1, length)
+                rows[table].append((binning.binFromRange(pos - 1, pos),
+                    chrom, pos, pos, rnd.choice(BASES), rnd.choice(BASES),
+                    'NM_' + str(i), 'G' + str(i), rnd.choice('+-'),
+                    rnd.choice(['CDS', 'intron', 'utr5', 'utr3',
+                    'non_coding_exon']), rnd.choice('012'), 'c.' + str(i),
+                    '', '0', 'AAA', 'K', 'AAG', 'K', rnd.choice('YN'),
+                    'silent', '', '', 'true', '', ''))
+        rows['chrom_pos_unequal'] = []
+        for i in range(scale):
+            start, end = interval(3000)
+            rows['chrom_pos_unequal'].append((binning.binFromRange(start - 1,
+                end), chrom, start, end, '', '', 'NM_u' + str(i),
+                'GU' + str(i), '+', rnd.choice(['intron',
+                'non_coding_intron']), '0', '', '', '12', '', '', '', '', '',
+                '', '', '', '', '', ''))
+
+        rows['refGene'] = []
+        rows['cpgIslandExt'] = []
+        for i in range(scale // 2 + 1):
+            start, end = interval(20000)
+            end = max(end, start + 1000)
+            exons = rnd.randint(1, 8)
+            bounds = sorted(rnd.sample(range(start, end), exons * 2))
+            starts, ends = bounds[0::2], bounds[1::2]
+            if (rnd.random() < 0.2):
+                cdsStart = cdsEnd = end
+            else:
+                cdsStart, cdsEnd = starts[0] + 10, ends[-1] - 10
+            rows['refGene'].append((binning.binFromRange(start, end),
+                'NM_' + chrom + '_' + str(i), chr, rnd.choice('+-'), start,
+                end, cdsStart, cdsEnd, exons,
+                ','.join([str(s) for s in starts]) + ',',
+                ','.join([str(e) for e in ends]) + ',', 0, 'GENE' + str(i),
+                'cmpl', 'cmpl', ''))
+            for island in [(start - 400, start - 100),
+                (end + 100, end + 400)]:
+                rows['cpgIslandExt'].append((binning.binFromRange(
+                    max(0, island[0]), island[1]), chr, max(0, island[0]),
+                    island[1], 'CpG: ' + str(i)))
+
+        bands = 20
+        rows['cytoBand'] = [(chr, b * length // bands,
+            (b + 1) * length // bands, 'p' + str(b // 3) + '.' + str(b),
+            'gneg') for b in range(bands)]
+
+        rows['gwasCatalog'] = []
+        for i in range(scale):
+            pos = rnd.randint(1, length)
+            rows['gwasCatalog'].append((binning.binFromRange(pos - 1, pos),
+                chr, pos - 1, pos, 'rs' + str(i), str(1000 + i), 'a', 'd',
+                'j', 't', 'Trait ' + str(i)))
+
+        for table in ['gadAll', 'hugo', 'genomicSuperDups', 'targetScanS',
+            'tfbsConsSites' + chrom] + CNV_TABLES:
+            rows[table] = []
+        for i in range(scale):
+            start, end = interval(5000)
+            rows['gadAll'].append((chrom, start, end, 'GAD' + str(i % 10)))
+            start, end = interval(5000)
+            rows['hugo'].append((binning.binFromRange(start, end), chr,
+                start, end, 'h', 'SYM' + str(i % 12), 'gene ' + str(i)))
+            start, end = interval(25000)
+            rows['genomicSuperDups'].append((binning.binFromRange(start, end),
+                chr, start, end, 'sd', 0, '+', 'chr7', 100, 200))
+            start, end = interval(4000)
+            rows['targetScanS'].append((binning.binFromRange(start, end),
+                chr, start, end, 'miR-' + str(i), 50, '+'))
+            start, end = interval(3000)
+            rows['tfbsConsSites' + chrom].append((binning.binFromRange(start,
+                end), chr, start, end, 'V$TF' + str(i), 800))
+            for table in CNV_TABLES:
+                start, end = interval(20000)
+                rows[table].append((binning.binFromRange(start, end), chr,
+                    start, end, 'cnv'))
+
+        for table, table_rows in rows.items():
+            insert(db, table, table_rows)
+
+    for table, columns in INDEXES:
+        db.execute('CREATE INDEX ' + table + '_idx ON ' + table + ' (' + \
+            columns + ');')
+    db.commit()
+    db.close()
+
+
+"""Writes a sorted synthetic VCF of variants records: a known fraction at
+   positions present in dbSNP/bigRefGene/gwasCatalog, an indel fraction
+   with multi-base alleles, the rest random SNVs
+"""
+def generateVcf(path, fixture, variants=10000, known=0.3, indels=0.1,
+    chromosomes=len(CHROMOSOMES), length=1000000, seed=2):
+
+    rnd = random.Random(seed)
+    chroms = CHROMOSOMES[:chromosomes]
+    db = sqlite3.connect(fixture)
+    positions = {}
+    for sql in ['select CHR, POS from dbSNP',
+        'select CHR, start from chrom_pos_equal_base',
+        'select CHR, start from chrom_pos_equal_nobase',
+        "select replace(chrom, 'chr', ''), chromEnd from gwasCatalog"]:
+        for chrom, pos in db.execute(sql):
+            positions.setdefault(chrom, []).append(pos)
+    db.close()
+
+    records = []
+    for i in range(variants):
+        chrom = rnd.choice(chroms)
+        if (rnd.random() < known) and positions.get(chrom):
+            pos = rnd.choice(positions[chrom])
+        else:
+            pos = rnd.randint(1, length)
+        ref = rnd.choice(BASES)
+        alt = rnd.choice(BASES.replace(ref, ''))
+        if (rnd.random() < indels):
+            if (rnd.random() < 0.5):
+                ref = ref + ''.join([rnd.choice(BASES)
+                    for b in range(rnd.randint(1, 5))])
+            else:
+                alt = alt + ''.join([rnd.choice(BASES)
+                    for b in range(rnd.randint(1, 5))])
+        records.append((chroms.index(chrom), pos, chrom, ref, alt,
+            rnd.choice(['.', '.', 'DP=10', 'AC=1;AN=2'])))
+    records.sort()
+
+    with open(path, 'w') as fh:
+        fh.write('##fileformat=VCFv4.0\n##source=benchmark\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n')
+        for index, pos, chrom, ref, alt, info in records:
+            fh.write('\t'.join([chrom, str(pos), '.', ref, alt, '50', 'PASS',
+                info, 'GT', '0/1']) + '\n')
+
+
+"""Points the pipeline at the fixture, with the caches that persist across
+   runs switched off
+"""
+def useFixture(fixture):
+    u.DB_CONNECT = lambda: SqliteConnection(fixture)
+    varcache.CACHE_PATH = ''
+    transcripts.TRANSCRIPT_CACHE_DIR = ''
+    ref.refresh()
+
+
+def variantCount(vcf):
+    return sum([1 for record in ann.readRecords(vcf)
+        if record.info is not None])
+
+
+def best(runs):
+    return min(runs) if runs else 0.0
+
+
+"""Seconds of each stage of driver.STAGES and OTHER_STAGES over the VCF,
+   on its own (best of repeat runs; preloaded tables are reloaded for every
+   run)
+"""
+def benchStages(vcf, repeat=3, stages=None, sweep=False):
+    overrides = driver.sweepOverrides() if sweep else None
+    results = []
+    for label, stage, options in driver.configuredStages(overrides) + \
+        OTHER_STAGES:
+        if stages and label not in stages:
+            continue
+        runs = []
+        for r in range(repeat):
+            ref.refresh()
+            records = list(ann.readRecords(vcf))
+            start = time.perf_counter()
+            for record in stage(records, format='vcf', log=[], **options):
+                pass
+            runs.append(time.perf_counter() - start)
+        results.append((label, best(runs)))
+    return results
+
+
+"""Seconds of driver.run over a copy of the VCF for each pipeline mode
+"""
+def benchPipeline(vcf, modes, repeat=3, workers=None, sweep=False):
+    results = []
+    workdir = os.path.dirname(vcf)
+    for mode in modes:
+        runs = []
+        for r in range(repeat):
+            ref.refresh()
+            infile = os.path.join(workdir, mode + '.vcf')
+            with open(vcf) as fh, open(infile, 'w') as fh_out:
+                fh_out.write(fh.read())
+            start = time.perf_counter()
+            driver.run(infile, 'vcf', mode=mode, workers=workers,
+                sweep=sweep)
+            runs.append(time.perf_counter() - start)
+        results.append((mode, best(runs)))
+    return results
+
+
+def commitId():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+            'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+"""Report lines: variants/sec per stage and pipeline mode, and the change
+   against a previous report if one is given
+"""
+def formatReport(report, previous=None):
+    before = {}
+    if previous is not None:
+        for entry in previous['stages'] + previous['pipeline']:
+            before[entry['name']] = entry['variants_per_sec']
+
+    lines = [f"commit {report['commit']}, {report['variants']} variants, " + \
+        f"options {json.dumps(report['options'], sort_keys=True)}"]
+    for entry in report['stages'] + report['pipeline']:
+        line = f"{entry['name']:<36} {entry['seconds']:>9.3f}s " + \
+            f"{entry['variants_per_sec']:>12.1f} variants/sec"
+        if before.get(entry['name']):
+            ratio = entry['variants_per_sec'] / before[entry['name']]
+            line = line + f"  ({ratio:.2f}x)"
+        lines.append(line)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Annotation benchmark ' + \
+        'on synthetic VCFs and a local SQLite reference fixture')
+    parser.add_argument('--variants', type=int, default=10000)
+    parser.add_argument('--known', type=float, default=0.3,
+        help='fraction of variants at positions present in the fixture')
+    parser.add_argument('--indels', type=float, default=0.1,
+        help='fraction of variants with multi-base alleles')
+    parser.add_argument('--chromosomes', type=int, default=len(CHROMOSOMES))
+    parser.add_argument('--scale', type=int, default=50,
+        help='fixture rows of each kind per chromosome')
+    parser.add_argument('--length', type=int, default=1000000,
+        help='simulated bases per chromosome')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', default='',
+        help='comma-separated stage labels (default: all)')
+    parser.add_argument('--modes', default='staged,fused',
+        help='comma-separated driver.run modes (empty: none)')
+    parser.add_argument('--workers', type=int, default=None,
+        help='worker processes of the sharded mode')
+    parser.add_argument('--sweep', action='store_true',
+        help='resolve region overlaps with sorted sweep-joins')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None,
+        help='write the report as JSON')
+    parser.add_argument('--compare', default=None,
+        help='JSON report of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='annbench')
+    os.makedirs(workdir, exist_ok=True)
+    fixture = os.path.join(workdir, 'reference.sqlite')
+    vcf = os.path.join(workdir, 'bench.vcf')
+
+    buildFixture(fixture, scale=args.scale, length=args.length,
+        seed=args.seed)
+    generateVcf(vcf, fixture, variants=args.variants, known=args.known,
+        indels=args.indels, chromosomes=args.chromosomes, length=args.length,
+        seed=args.seed + 1)
+    useFixture(fixture)
+    variants = variantCount(vcf)
+
+    stages = [s for s in args.stages.split(',') if s]
+    modes = [m for m in args.modes.split(',') if m]
+    report = {'commit': commitId(), 'python': platform.python_version(),
+        'variants': variants, 'options': {'variants': args.variants,
+        'known': args.known, 'indels': args.indels,
+        'chromosomes': args.chromosomes, 'scale': args.scale,
+        'length': args.length, 'seed': args.seed, 'repeat': args.repeat,
+        'sweep': args.sweep},
+        'stages': [], 'pipeline': []}
+    for key, results in [('stages', benchStages(vcf, args.repeat, stages,
+        args.sweep)), ('pipeline', benchPipeline(vcf, modes, args.repeat,
+        args.workers, args.sweep))]:
+        for name, seconds in results:
+            report[key].append({'name': name, 'seconds': round(seconds, 6),
+                'variants_per_sec': round(variants / seconds, 1)
+                if seconds else 0.0})
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+    for line in formatReport(report, previous):
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+            fh.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+### EOF
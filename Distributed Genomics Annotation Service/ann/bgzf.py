@@ -0,0 +1,142 @@
+# bgzf.py
+#
+#
+# Streaming gzip/BGZF input and output of VCF files
+#
+# Compressed input (plain gzip or BGZF, which is a series of gzip members)
+# is recognised by its magic bytes and decompressed while it is read.
+# Output files named *.gz are written as BGZF, the blocked gzip format of
+# bgzip/tabix: the text is cut into blocks of up to BLOCK_SIZE bytes that
+# are deflated in parallel on COMPRESS_THREADS threads (zlib releases the
+# GIL) and written in order.
+#
+##
+
+import io
+import gzip
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads deflating BGZF blocks of an output file
+COMPRESS_THREADS = 4
+
+# zlib compression level of BGZF output
+COMPRESS_LEVEL = 6
+
+# Uncompressed bytes per BGZF block (as bgzip), so that a deflated block
+# always fits the 64 KiB block size limit
+BLOCK_SIZE = 0xff00
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b00' + \
+    '03000000000000000000')
+
+
+"""Whether filename starts with the gzip magic bytes
+"""
+def isCompressed(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+"""One BGZF block: a gzip member whose BC extra field holds its size
+"""
+def compressBlock(data, level=None):
+    deflate = zlib.compressobj(COMPRESS_LEVEL if level is None else level,
+        zlib.DEFLATED, -15)
+    compressed = deflate.compress(data) + deflate.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+        66, 67, 2, len(compressed) + 25)
+    return header + compressed + \
+        struct.pack('<II', zlib.crc32(data), len(data))
+
+
+"""Binary writer producing a BGZF file; blocks are compressed ahead on a
+   thread pool, keeping at most two blocks per thread in memory
+"""
+class BgzfWriter(io.RawIOBase):
+    def __init__(self, filename, threads=None, level=None):
+        self.fh = open(filename, 'wb')
+        self.level = level
+        self.threads = max(1, COMPRESS_THREADS if threads is None else threads)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.buffer = bytearray()
+        self.blocks = collections.deque()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, data):
+        self.blocks.append(self.executor.submit(compressBlock, data,
+            self.level))
+        while (len(self.blocks) > 2 * self.threads):
+            self.fh.write(self.blocks.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.blocks:
+                self.fh.write(self.blocks.popleft().result())
+            self.fh.write(EOF_BLOCK)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.fh.close()
+            super().close()
+
+
+"""Opens a VCF file as text: mode 'r' decompresses gzip/BGZF input, mode
+   'w' writes BGZF if filename ends with .gz, plain text otherwise
+"""
+def openText(filename, mode='r'):
+    if mode.startswith('r'):
+        if isCompressed(filename):
+            return gzip.open(filename, 'rt')
+        return open(filename)
+
+    if filename.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(filename),
+            buffer_size=BLOCK_SIZE))
+    return open(filename, 'w')
+
+
+"""Opens a plain or compressed file as bytes, for reading (mode 'r') or
+   writing (mode 'w', BGZF if filename ends with .gz)
+"""
+def openBinary(filename, mode='r'):
+    if mode.startswith('r'):
+        if isCompressed(filename):
+            return gzip.open(filename, 'rb')
+        return open(filename, 'rb')
+
+    if filename.endswith('.gz'):
+        return io.BufferedWriter(BgzfWriter(filename), buffer_size=BLOCK_SIZE)
+    return open(filename, 'wb')
+
+
+"""Writes the contents of a plain or compressed file to dst (BGZF if dst
+   ends with .gz)
+"""
+def copyFile(src, dst):
+    with openText(src) as fh, openText(dst, 'w') as fh_out:
+        while True:
+            chunk = fh.read(BLOCK_SIZE)
+            if not chunk:
+                break
+            fh_out.write(chunk)
+
+### EOF
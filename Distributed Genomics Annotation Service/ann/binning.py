@@ -0,0 +1,135 @@
+# binning.py
+#
+#
+# UCSC binning index support for range queries against reference tables
+#
+# The UCSC schema stores, for every feature, the smallest bin of a fixed
+# hierarchy (128kb, 1Mb, 8Mb, 64Mb, 512Mb) that contains it. A feature can
+# only overlap a region if it sits in one of the bins covering that region,
+# so "bin IN (...)" lets MySQL use the (chrom, bin) index instead of
+# scanning every row of the chromosome.
+#
+# Run as a script to add bin columns and indexes to region tables that
+# lack them: python binning.py [table ...]
+#
+##
+
+import sys
+import utils as u
+import statements as st
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+# Region tables the migration adds bin columns and indexes to
+REGION_TABLES = ['tfbsConsSites' + c for c in
+    [str(i) for i in range(1, 23)] + ['X', 'Y']] + \
+    ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv',
+    'genomicSuperDups', 'cpgIslandExt']
+
+_has_bin = {}
+
+
+"""Smallest bin containing the 0-based, half-open range [start, end)
+"""
+def binFromRange(start, end):
+    startBin = start >> BIN_FIRST_SHIFT
+    endBin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if (startBin == endBin):
+            return offset + startBin
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    raise ValueError(f"binFromRange: range {start}-{end} out of bounds")
+
+
+"""Every bin a feature overlapping [start, end) can be stored in
+"""
+def binsForRange(start, end):
+    bins = []
+    startBin = max(0, start) >> BIN_FIRST_SHIFT
+    endBin = max(0, end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + startBin, offset + endBin + 1))
+        startBin = startBin >> BIN_NEXT_SHIFT
+        endBin = endBin >> BIN_NEXT_SHIFT
+    return bins
+
+
+"""Whether table has a bin column (checked once per table and process)
+"""
+def tableHasBin(cursor, table):
+    if table not in _has_bin:
+        statement = st.prepare('binning.columns',
+            'select * from {table} limit 0;', table=table)
+        statement.fetchall(cursor)
+        _has_bin[table] = 'bin' in [d[0] for d in cursor.description]
+    return _has_bin[table]
+
+
+"""Query fragment " AND bin IN (%s,...)" and its parameters, the candidate
+   bins of features overlapping the 1-based positions first..last padded
+   by offset; ('', []) if table has no bin column. The candidate set is a
+   superset: the position conditions of the query still decide what matches
+"""
+def binFilter(cursor, table, first, last=None, offset=0):
+    if not tableHasBin(cursor, table):
+        return '', []
+    last = first if last is None else last
+    bins = binsForRange(int(first) - int(offset) - 1,
+        int(last) + int(offset) + 1)
+    return ' AND bin IN (' + st.placeholders(len(bins)) + ')', bins
+
+
+"""SQL expression computing the bin of each row from its coordinates
+"""
+def binExpression(startCol='chromStart', endCol='chromEnd'):
+    cases = []
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS[:-1]:
+        cases.append(f"WHEN ({startCol} >> {shift}) = (({endCol} - 1) >> " + \
+            f"{shift}) THEN {offset} + ({startCol} >> {shift})")
+        shift = shift + BIN_NEXT_SHIFT
+    return 'CASE ' + ' '.join(cases) + ' ELSE 0 END'
+
+
+"""Adds a bin column (filled from chromStart/chromEnd) and a composite
+   index to a region table that lacks them. Tables split per chromosome
+   (no chrom column) are indexed on bin alone
+"""
+def addBinIndex(cursor, table, startCol='chromStart', endCol='chromEnd'):
+    st.prepare('binning.columns', 'select * from {table} limit 0;',
+        table=table).fetchall(cursor)
+    columns = [d[0] for d in cursor.description]
+
+    if 'bin' not in columns:
+        print(f"{table}: adding bin column")
+        cursor.execute('ALTER TABLE ' + table + ' ADD COLUMN bin ' + \
+            'SMALLINT UNSIGNED NOT NULL DEFAULT 0 FIRST;')
+        cursor.execute('UPDATE ' + table + ' SET bin = ' + \
+            binExpression(startCol, endCol) + ';')
+
+    index_columns = 'chrom, bin' if 'chrom' in columns else 'bin'
+    cursor.execute('SHOW INDEX FROM ' + table + ' WHERE Key_name = "bin_idx";')
+    if (len(cursor.fetchall()) == 0):
+        print(f"{table}: adding index bin_idx ({index_columns})")
+        cursor.execute('CREATE INDEX bin_idx ON ' + table + \
+            ' (' + index_columns + ');')
+
+    _has_bin[table] = True
+
+
+def migrate(tables=None):
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    for table in (tables or REGION_TABLES):
+        addBinIndex(cursor, table)
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1:])
+
+### EOF
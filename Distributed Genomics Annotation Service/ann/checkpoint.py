@@ -0,0 +1,265 @@
+# checkpoint.py
+#
+#
+# Checkpoints of staged and fused pipeline runs
+#
+# A staged run records its progress in <input>.checkpoint.json: a
+# fingerprint of the input (SHA-256, size and line count) and of the stage
+# table, the last stage whose intermediate file <input>.k is complete, and,
+# every CHECKPOINT_LINES lines, how far the running stage has got. A rerun
+# of the same job on the same host resumes at that line of the running
+# stage; completed stages can also be persisted to a STORE (e.g. S3) so
+# that a job moved to another host resumes at the first incomplete stage.
+# A fused run is checkpointed as a single stage writing <input>.1.
+#
+##
+
+import os
+import json
+import hashlib
+import itertools
+import annotate as ann
+import instrument
+
+# Lines written by a stage between two checkpoints of its progress
+# (0 = checkpoint at stage boundaries only)
+CHECKPOINT_LINES = 100000
+
+# Store persisting completed stages across hosts (an object with save,
+# restore and delete taking a local file name, like S3Store); None = local
+# checkpoints only
+STORE = None
+
+VERSION = 1
+
+
+def manifestName(basefile):
+    return basefile + '.checkpoint.json'
+
+
+def stageFile(basefile, index):
+    return basefile + '.' + str(index) if index > 0 else basefile
+
+
+def fileSize(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+
+"""SHA-256, size and line count of a file, read in blocks
+"""
+def fingerprint(filename, block_size=1 << 20):
+    digest = hashlib.sha256()
+    lines = 0
+    size = 0
+    with open(filename, 'rb') as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+            lines = lines + block.count(b'\n')
+            size = size + len(block)
+    return {'sha256': digest.hexdigest(), 'bytes': size, 'lines': lines}
+
+
+"""Hash of the stage labels and options, the input format and the pipeline
+   mode: checkpoints of a differently configured pipeline are not resumed
+"""
+def pipelineHash(stages, format, mode='staged'):
+    table = [(label, sorted(options.items())) for label, stage, options
+        in stages]
+    return hashlib.sha256(json.dumps([format, table, mode], default=str,
+        sort_keys=True).encode()).hexdigest()
+
+
+"""Keeps checkpoints in s3://<bucket>/<prefix><file name>
+"""
+class S3Store(object):
+    def __init__(self, bucket, prefix, region_name=None):
+        import boto3
+        from botocore.exceptions import ClientError
+        self.client = boto3.client('s3', region_name=region_name)
+        self.error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, filename):
+        return self.prefix + os.path.basename(filename)
+
+    def save(self, filename):
+        self.client.upload_file(filename, self.bucket, self.key(filename))
+
+    def restore(self, filename):
+        try:
+            self.client.download_file(self.bucket, self.key(filename),
+                filename)
+            return True
+        except self.error:
+            return False
+
+    def delete(self, filename):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(filename))
+
+
+"""Progress of one staged run over basefile
+   resume() returns the index of the first stage to run; runStage() runs a
+   stage from the preceding intermediate file, checkpointing as it goes.
+   A fused run (mode='fused') is a single stage running the whole chain
+"""
+class Checkpoint(object):
+    def __init__(self, basefile, stages, format, store=None, mode='staged'):
+        self.basefile = basefile
+        self.logfile = basefile + '.count.log'
+        self.store = STORE if store is None else store
+        self.manifest = {'version': VERSION,
+            'input': fingerprint(basefile),
+            'pipeline': pipelineHash(stages, format, mode),
+            'completed': 0, 'bytes': None, 'log_bytes': 0, 'partial': None}
+
+    def load(self):
+        name = manifestName(self.basefile)
+        restored = not os.path.exists(name) and self.store is not None and \
+            self.store.restore(name)
+        try:
+            with open(name) as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if restored:
+            self.restoreFiles(manifest)
+        return manifest
+
+    """Fetches the latest completed intermediate file and the log from the
+       store (in-stage progress is local only)
+    """
+    def restoreFiles(self, manifest):
+        completed = manifest.get('completed', 0)
+        if (completed > 0) and not self.store.restore(stageFile(
+            self.basefile, completed)):
+            return
+        if manifest.get('log_bytes'):
+            self.store.restore(self.logfile)
+
+    """Whether the recorded state belongs to this input and pipeline and
+       its files are still there
+    """
+    def valid(self, manifest):
+        if manifest is None or manifest.get('version') != VERSION:
+            return False
+        if manifest['input'] != self.manifest['input'] or \
+            manifest['pipeline'] != self.manifest['pipeline']:
+            return False
+        if (manifest['completed'] > 0) and (fileSize(stageFile(
+            self.basefile, manifest['completed'])) != manifest['bytes']):
+            return False
+        if (fileSize(self.logfile) or 0) < manifest['log_bytes']:
+            return False
+        partial = manifest['partial']
+        if partial and ((fileSize(stageFile(self.basefile,
+            partial['stage'])) or 0) < partial['bytes']):
+            manifest['partial'] = None
+        return True
+
+    """Index of the first stage to run: 1, or the stage after the last
+       completed one of an earlier run of the same job
+    """
+    def resume(self):
+        manifest = self.load()
+        if self.valid(manifest):
+            self.manifest = manifest
+            if manifest['partial']:
+                print(f"Resuming stage {manifest['partial']['stage']} " + \
+                    f"at line {manifest['partial']['lines']}")
+            elif manifest['completed'] > 0:
+                print(f"Resuming after stage {manifest['completed']}")
+        self.save()
+        return self.manifest['completed'] + 1
+
+    def save(self):
+        name = manifestName(self.basefile)
+        with open(name + '.tmp', 'w') as fh:
+            json.dump(self.manifest, fh, indent=2)
+            fh.write('\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(name + '.tmp', name)
+
+    """Runs stage index from the preceding intermediate file (or the input)
+       to the next, skipping the lines a previous attempt already wrote;
+       source(filename, log) replaces readRecords, as in annotate.runStage
+    """
+    def runStage(self, index, stage, logmode='a', sep='\t', source=None,
+        **kwargs):
+        outfile = stageFile(self.basefile, index)
+        partial = self.manifest['partial']
+        skip = 0
+        if partial and (partial['stage'] == index):
+            skip = partial['lines']
+            with open(outfile, 'r+b') as fh:
+                fh.truncate(partial['bytes'])
+        if os.path.exists(self.logfile) and (logmode != 'w' or skip):
+            with open(self.logfile, 'r+b') as fh:
+                fh.truncate(self.manifest['log_bytes'])
+
+        log = []
+        if source is None:
+            records = ann.readRecords(stageFile(self.basefile, index - 1),
+                sep=sep)
+        else:
+            records = source(stageFile(self.basefile, index - 1), log)
+        lines = skip
+        with open(outfile, 'ab' if skip else 'wb') as fh_out:
+            for record in stage(itertools.islice(records, skip, None),
+                log=log, **kwargs):
+                line = (str(record) + '\n').encode()
+                instrument.count('bytes_written', len(line))
+                fh_out.write(line)
+                lines = lines + 1
+                if CHECKPOINT_LINES and (lines % CHECKPOINT_LINES == 0):
+                    fh_out.flush()
+                    os.fsync(fh_out.fileno())
+                    self.manifest['partial'] = {'stage': index,
+                        'lines': lines, 'bytes': fh_out.tell()}
+                    self.save()
+
+        with open(self.logfile, 'w' if (logmode == 'w' and not skip)
+            else 'a') as fh_log:
+            if skip:
+                fh_log.write(f"## Resumed at line {skip}: counts below " + \
+                    "cover the lines after it\n")
+        ann.writeLog(self.basefile, log, mode='a')
+        self.complete(index)
+
+    """Records stage index as complete and persists it to the store
+    """
+    def complete(self, index):
+        outfile = stageFile(self.basefile, index)
+        self.manifest['completed'] = index
+        self.manifest['bytes'] = fileSize(outfile)
+        self.manifest['log_bytes'] = fileSize(self.logfile) or 0
+        self.manifest['partial'] = None
+        self.save()
+        if self.store is not None:
+            self.store.save(outfile)
+            self.store.save(self.logfile)
+            self.store.save(manifestName(self.basefile))
+            if (index > 1):
+                self.store.delete(stageFile(self.basefile, index - 1))
+
+    """Removes the checkpoints of a finished run
+    """
+    def finish(self):
+        name = manifestName(self.basefile)
+        if self.store is not None:
+            self.store.delete(name)
+            self.store.delete(self.logfile)
+            if self.manifest['completed'] > 0:
+                self.store.delete(stageFile(self.basefile,
+                    self.manifest['completed']))
+        if os.path.exists(name):
+            os.unlink(name)
+
+### EOF
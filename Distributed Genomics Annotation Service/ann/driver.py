@@ -12,110 +12,488 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import file_utils as fu
 import annotate as ann
+import pileup2vcf as p2v
+import bgzf
+import statements as st
+import instrument
+import checkpoint
+import time
 
-def run(infile, format):
+# A shard is only closed at a chromosome (or range) boundary once it holds
+# at least this many records, so unsorted input does not explode into
+# thousands of tiny shards
+SHARD_MIN_RECORDS = 1000
 
-    print("Running . . .")
+# Write the annotated file BGZF compressed (.annot.vcf.gz) even when the
+# input is not; compressed input always gives compressed output
+COMPRESS_OUTPUT = False
+
+# Drop variants with REF = ALT or on other chromosomes than 1-22, X, Y and
+# MT (pileup2vcf.filter_vcf) before any stage looks them up
+FILTER_VARIANTS = True
+
+"""Annotation stages in the order they are applied: (label, stage, options)
+   Region overlaps all run ann.regionStage with an annotator registered in
+   ann.REGION_ANNOTATORS; the CNV databases share one ann.multiRegionStage
+"""
+STAGES = [
+    ("dbSNP", ann.getSnpsFromDbSnpStage, {}),
+    ("BigRefGene", ann.getBigRefGeneStage, {}),
+    ("refGene", ann.getGenesStage,
+        {'table': 'refGene', 'promoter_offset': 500}),
+    ("Cytoband", ann.regionStage, {'annotator': 'cytoBand'}),
+    ("gadAll", ann.regionStage, {'annotator': 'gadAll'}),
+    ("GwasCatalog", ann.regionStage, {'annotator': 'gwasCatalog'}),
+    ("miRNA", ann.regionStage, {'annotator': 'targetScanS'}),
+    ("HUGO Gene Nomenclature Committee", ann.regionStage,
+        {'annotator': 'hugo'}),
+    ("CNV", ann.multiRegionStage, {'annotators': ann.CNV_TABLES}),
+    ("genomicSuperDups", ann.regionStage, {'annotator': 'genomicSuperDups'}),
+    ("addOverlapWithTfbsConsSites", ann.regionStage,
+        {'annotator': 'tfbsConsSites'}),
+]
+
+
+"""Name of the annotated output file for an input file: x.vcf gives
+   x.annot.vcf, x.vcf.gz (or x.vcf with COMPRESS_OUTPUT) x.annot.vcf.gz;
+   x.pileup is annotated as x.vcf
+"""
+def annotatedName(infile):
+    compressed = COMPRESS_OUTPUT or infile.endswith('.gz')
+    if infile.endswith('.gz'):
+        infile = infile[:-len('.gz')]
+    if infile.endswith('.pileup'):
+        infile = infile[:-len('.pileup')] + '.vcf'
+    name = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    return name + '.gz' if compressed else name
+
+
+"""Format of an input file: 'pileup' for samtools (variant) pileup files,
+   named x.pileup or x.pileup.gz, and 'vcf' otherwise
+"""
+def inputFormat(infile):
+    if infile.endswith('.gz'):
+        infile = infile[:-len('.gz')]
+    return 'pileup' if infile.endswith('.pileup') else 'vcf'
+
+
+"""Format of the records the stages see: pileup input is converted to VCF
+"""
+def stageFormat(format):
+    return 'vcf' if (format == 'pileup') else format
+
+
+"""Records of the input file: pileup is converted to VCF records as it is
+   read, with no intermediate .vcf file, and with FILTER_VARIANTS the
+   variants filter_vcf would drop are skipped before the first stage.
+   header=False leaves out the VCF header of pileup input (shards)
+"""
+def inputRecords(infile, format, log=None, header=True):
+    if (format == 'pileup'):
+        records = p2v.pileup_records(infile, header=header)
+    else:
+        records = ann.readRecords(infile)
+    if FILTER_VARIANTS:
+        records = p2v.filter_stage(records, log=log)
+    return records
+
+
+# Stages that read the INFO annotations of other stages; every other stage
+# only reads the input columns, so the dag mode runs it alongside the rest
+DEPENDENCIES = {"refGene": ["BigRefGene"]}
+
+
+# Stages that can resolve positions with a sorted sweep-join (sweep.py)
+SWEEP_STAGES = ["Cytoband", "gadAll", "GwasCatalog", "miRNA",
+    "HUGO Gene Nomenclature Committee", "CNV", "genomicSuperDups",
+    "addOverlapWithTfbsConsSites"]
+
+
+"""Overrides with sweep-joins switched on for every SWEEP_STAGES stage;
+   explicit per-stage overrides still take precedence
+"""
+def sweepOverrides(overrides=None):
+    overrides = dict(overrides or {})
+    for label in SWEEP_STAGES:
+        overrides[label] = dict({'sweep': True}, **overrides.get(label, {}))
+    return overrides
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+
+"""Stage table with per-stage option overrides applied, e.g.
+   {'dbSNP': {'batch_size': 500}}
+"""
+def configuredStages(overrides=None):
+    overrides = overrides or {}
+    return [(label, stage, dict(options, **overrides.get(label, {})))
+        for label, stage, options in STAGES]
+
+
+"""Runs every stage over the input, one intermediate file per stage
+   With checkpoints, a rerun of the same job resumes where the last one
+   stopped (checkpoint.py)
+"""
+def runStaged(infile, format, overrides=None, checkpoints=False):
+    stages = configuredStages(overrides)
+    progress = None
+    first = 1
+    if checkpoints:
+        progress = checkpoint.Checkpoint(infile, stages, format)
+        first = progress.resume()
+
+    tmpextin = '.' + str(first - 1) if first > 1 else ''
+    for i, (label, stage, options) in enumerate(stages[first - 1:],
+        start=first):
+        tmpextout = '.' + str(i)
+        # The first stage reads the input, later ones intermediate files
+        source = None
+        if (i == 1):
+            source = lambda filename, log: inputRecords(filename, format, log)
+        with instrument.timing(label):
+            if progress is not None:
+                progress.runStage(i, instrument.timedStage(label, stage),
+                    logmode=('w' if i == 1 else 'a'), source=source,
+                    format=stageFormat(format), **options)
+            else:
+                ann.runStage(instrument.timedStage(label, stage), infile,
+                    tmpextin, tmpextout, logmode=('w' if i == 1 else 'a'),
+                    source=source, format=stageFormat(format), **options)
+        print(label + " - done.")
+        tmpextin = tmpextout
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(stages)):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    moveOutput(infile + tmpextin, annotatedName(infile))
+    if progress is not None:
+        progress.finish()
+
+
+"""Moves the last intermediate file to the annotated file, compressing it
+   if that is named .gz
+"""
+def moveOutput(filename, outfile):
+    if outfile.endswith('.gz'):
+        with instrument.timing(instrument.OUTPUT):
+            bgzf.copyFile(filename, outfile)
+        fu.delete(filename)
+    else:
+        os.rename(filename, outfile)
+
+
+"""Chains every stage over a stream of records, each stage timed and
+   counted in its own instrument scope
+"""
+def annotateRecords(records, format, overrides=None, log=None):
+    records = instrument.timed(instrument.INPUT, records)
+    for label, stage, options in configuredStages(overrides):
+        records = instrument.timed(label, ann.restrip(stage(records,
+            format=stageFormat(format), log=log, **options)))
+    return records
+
+
+"""Streams each record through every stage in memory: the input is
+   parsed once and the output written once, with no intermediate files
+   With checkpoints, the chain runs as a single checkpointed stage writing
+   <input>.1, and a rerun resumes at the last line it recorded
+"""
+def runFused(infile, format, overrides=None, checkpoints=False):
+    if checkpoints:
+        progress = checkpoint.Checkpoint(infile, configuredStages(overrides),
+            format, mode='fused')
+        if (progress.resume() == 1):
+            with instrument.timing(instrument.OUTPUT):
+                progress.runStage(1, lambda records, log: annotateRecords(
+                    records, format, overrides, log), logmode='w',
+                    source=lambda filename, log: inputRecords(filename,
+                    format, log))
+        moveOutput(infile + '.1', annotatedName(infile))
+        progress.finish()
+        print("Fused pipeline (" + str(len(STAGES)) + " stages) - done.")
+        return
+
+    log = []
+    records = inputRecords(infile, format, log)
+    with instrument.timing(instrument.OUTPUT):
+        ann.writeRecords(annotateRecords(records, format, overrides, log),
+            annotatedName(infile))
+    ann.writeLog(infile, log, mode='w')
+    print("Fused pipeline (" + str(len(STAGES)) + " stages) - done.")
+
+
+"""Splits a VCF into shard files of consecutive records on the same
+   chromosome (shard_size=0) or in the same shard_size-wide range of a
+   chromosome. Returns the leading header lines and the shard file names,
+   in input order
+"""
+def splitShards(infile, shard_size=0, sep='\t'):
+    headers = []
+    shards = []
+    fh_out = None
+    current = None
+    count = 0
+
+    with bgzf.openText(infile) as fh:
+        for line in fh:
+            line = line.strip()
+            fields = line.split(sep, 2)
+
+            if ann.isHeader(fields):
+                if fh_out is None:
+                    headers.append(line)
+                    continue
+            else:
+                key = fields[0].strip()
+                if shard_size:
+                    key = (key, int(fields[1]) // shard_size)
+
+                if fh_out is None or \
+                    (key != current and count >= SHARD_MIN_RECORDS):
+                    if fh_out is not None:
+                        fh_out.close()
+                    shards.append(infile + '.shard' + str(len(shards)))
+                    fh_out = open(shards[-1], 'w')
+                    count = 0
+                current = key
+                count = count + 1
+
+            fh_out.write(line + '\n')
+
+    if fh_out is not None:
+        fh_out.close()
+
+    return headers, shards
+
+
+"""Annotates one shard file in a worker process; returns its statistics,
+   the query latencies and the instrument counters of the shard
+"""
+def annotateShard(shardfile, format, overrides=None):
+    log = []
+    st.resetStats()
+    instrument.reset()
+    records = inputRecords(shardfile, format, log, header=False)
+    with instrument.timing(instrument.OUTPUT):
+        ann.writeRecords(annotateRecords(records, format, overrides, log),
+            shardfile + '.annot')
+    return log, st.stats(), instrument.counters()
+
+
+"""Splits the input into shards, annotates them in a process pool and
+   merges the results back in input order, with the header written once
+   and the .count.log totals added up across shards
+"""
+def runSharded(infile, format, overrides=None, workers=None, shard_size=0):
+    with instrument.timing(instrument.INPUT):
+        headers, shards = splitShards(infile, shard_size=shard_size)
+    if (format == 'pileup'):
+        headers = p2v.vcfheader(infile).split('\n') + headers
+    if (len(shards) < 2):
+        for shard in shards:
+            fu.delete(shard)
+        runFused(infile, format, overrides)
+        return
+
+    logs = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(annotateShard, shard, format, overrides)
+                for shard in shards]
+
+            with bgzf.openText(annotatedName(infile), 'w') as fh_out:
+                for line in headers:
+                    fh_out.write(line + '\n')
+                for shard, future in zip(shards, futures):
+                    log, stats, counters = future.result()
+                    logs.append(log)
+                    st.mergeStats(stats)
+                    instrument.mergeCounters(counters)
+                    with open(shard + '.annot') as fh:
+                        shutil.copyfileobj(fh, fh_out)
+                    fu.delete(shard + '.annot')
+    finally:
+        for shard in shards:
+            fu.delete(shard)
+            fu.delete(shard + '.annot')
+
+    ann.writeLog(infile, ann.mergeLogs(logs), mode='w')
+    print("Sharded pipeline (" + str(len(shards)) + " shards) - done.")
+
+
+"""Groups the stages into branches: chains of stages that read the INFO
+   annotations of earlier stages of the same chain (DEPENDENCIES). Each
+   branch holds (stage index, label, stage, options) in stage order
+"""
+def stageBranches(stages):
+    branches = []
+    owner = {}
+    for i, (label, stage, options) in enumerate(stages):
+        joined = []
+        for dependency in DEPENDENCIES.get(label, []):
+            branch = owner.get(dependency)
+            if branch is not None and branch not in joined:
+                joined.append(branch)
+        branch = joined[0] if joined else []
+        for other in joined[1:]:
+            branch.extend(other)
+            branches.remove(other)
+            for entry in other:
+                owner[entry[1]] = branch
+        if not joined:
+            branches.append(branch)
+        branch.append((i, label, stage, options))
+        branch.sort(key=lambda entry: entry[0])
+        owner[label] = branch
+    return branches
+
+
+"""Passes records through, noting the length of each variant's INFO
+   annotations (joined with ';') in marks, in record order
+"""
+def infoMarks(records, marks):
+    for record in records:
+        if record.info is None:
+            marks.append(None)
+        else:
+            marks.append(len(';'.join(record.info)))
+        yield record
+
+
+"""Runs the stages of one branch over the whole input in a worker process
+   and writes each annotated line followed by the INFO marks of the input
+   and of every stage (see mergeBranches). Returns the log entries of each
+   stage, the query latencies and the instrument counters
+"""
+def annotateBranch(infile, outfile, labels, format, overrides=None):
+    st.resetStats()
+    instrument.reset()
+    logs = dict([(label, []) for label in labels])
+    stages = [entry for entry in configuredStages(overrides)
+        if entry[0] in labels]
+    marks = [collections.deque() for i in range(len(stages) + 1)]
+
+    records = infoMarks(instrument.timed(instrument.INPUT,
+        inputRecords(infile, format)), marks[0])
+    for j, (label, stage, options) in enumerate(stages, start=1):
+        records = infoMarks(instrument.timed(label, ann.restrip(stage(records,
+            format=stageFormat(format), log=logs[label], **options))),
+            marks[j])
+
+    with instrument.timing(instrument.OUTPUT), open(outfile, 'w') as fh_out:
+        for record in records:
+            offsets = [queue.popleft() for queue in marks]
+            fh_out.write(str(record) + '\t' + ('.' if offsets[0] is None
+                else ','.join([str(m) for m in offsets])) + '\n')
+    return logs, st.stats(), instrument.counters()
+
+
+"""INFO annotations added by each stage of a branch, given the INFO column
+   the branch wrote and the marks of infoMarks
+"""
+def addedInfo(info, offsets):
+    info = '' if (info == '.') else info
+    added = []
+    for start, end in zip(offsets, offsets[1:]):
+        # Each stage's annotations follow a ';' unless INFO was empty
+        added.append(info[start + 1 if start else start:end])
+    return added
+
+
+"""Merges the branch outputs into the records of the input (read as the
+   branches read it, see inputRecords): columns other than INFO take the
+   value a branch changed them to, and the INFO annotations each stage
+   added are appended in stage order
+"""
+def mergeBranches(infile, format, branches, branchfiles, log=None):
+    order = sorted([(i, b, j) for b, branch in enumerate(branches)
+        for j, (i, label, stage, options) in enumerate(branch)])
+    readers = [open(name) for name in branchfiles]
+    try:
+        for record in inputRecords(infile, format, log):
+            lines = [fh.readline().rstrip('\n').split('\t') for fh in readers]
+            if record.info is None:
+                yield record
+                continue
+
+            added = []
+            original = list(record.fields)
+            for columns in lines:
+                offsets = [int(m) for m in columns[-1].split(',')]
+                added.append(addedInfo(columns[ann.INFO], offsets))
+                for c in range(min(len(original), len(columns) - 1)):
+                    if (c != ann.INFO) and (columns[c] != original[c]):
+                        record[c] = columns[c]
+            record.annotate(*[added[b][j] for i, b, j in order])
+            yield record
+    finally:
+        for fh in readers:
+            fh.close()
+
+
+"""Runs the branches of independent stages concurrently, one worker
+   process per branch reading the whole input, and merges their INFO
+   annotations line by line in stage order: the job takes about as long
+   as its slowest branch
+"""
+def runDag(infile, format, overrides=None, workers=None):
+    stages = configuredStages(overrides)
+    branches = stageBranches(stages)
+    branchfiles = [infile + '.branch' + str(b) for b in range(len(branches))]
+
+    log = []
+    logs = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers or len(branches)) \
+            as pool:
+            futures = [pool.submit(annotateBranch, infile, branchfile,
+                [entry[1] for entry in branch], format, overrides)
+                for branch, branchfile in zip(branches, branchfiles)]
+            for future in futures:
+                branch_logs, stats, counters = future.result()
+                logs.update(branch_logs)
+                st.mergeStats(stats)
+                instrument.mergeCounters(counters)
+
+        with instrument.timing(instrument.OUTPUT):
+            ann.writeRecords(mergeBranches(infile, format, branches,
+                branchfiles, log), annotatedName(infile))
+    finally:
+        for branchfile in branchfiles:
+            fu.delete(branchfile)
+
+    ann.writeLog(infile, log + [entry for label, stage, options in stages
+        for entry in logs[label]], mode='w')
+    print("DAG pipeline (" + str(len(branches)) + " branches) - done.")
+
+
+def run(infile, format, mode='staged', overrides=None, workers=None,
+    shard_size=0, sweep=False, checkpoints=False):
+
+    print("Running . . .")
+
+    if sweep:
+        overrides = sweepOverrides(overrides)
+
+    instrument.reset([instrument.INPUT] + [label for label, stage, options
+        in STAGES] + [instrument.OUTPUT])
+    start = time.perf_counter()
+    if checkpoints and (mode in ('dag', 'sharded')):
+        print("Checkpoints are only kept in staged and fused mode; " + \
+            "the " + mode + " run starts from the beginning")
+    if (mode == 'fused'):
+        runFused(infile, format, overrides, checkpoints=checkpoints)
+    elif (mode == 'dag'):
+        runDag(infile, format, overrides, workers=workers)
+    elif (mode == 'sharded'):
+        runSharded(infile, format, overrides, workers=workers,
+            shard_size=shard_size)
+    else:
+        runStaged(infile, format, overrides, checkpoints=checkpoints)
+    instrument.writeReport(infile, mode, time.perf_counter() - start)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,150 @@
+# instrument.py
+#
+#
+# Per-annotator instrumentation of a pipeline run
+#
+# Counters are kept per scope, the label of the stage whose code is
+# running: wall time (excluding the stages it pulls records from), records
+# processed, SQL statements issued and rows fetched (statements.py), cache
+# hits and misses (varcache.py) and bytes read and written. The scope is a
+# context variable, so lookups running on other threads are counted
+# against the stage that submitted them. driver.run writes the counters as
+# JSON next to the .count.log.
+#
+##
+
+import json
+import time
+import threading
+import contextvars
+
+SCOPE = contextvars.ContextVar('scope', default=None)
+
+# Scopes of the pipeline around the stages
+INPUT = 'input'
+OUTPUT = 'output'
+
+_counters = {}
+_order = []
+_lock = threading.Lock()
+_frames = threading.local()
+
+
+"""Adds n to counter name of the current scope (if any)
+"""
+def count(name, n=1):
+    scope = SCOPE.get()
+    if scope is None:
+        return
+    with _lock:
+        counters = _counters.get(scope)
+        if counters is None:
+            counters = _counters[scope] = {}
+            _order.append(scope)
+        counters[name] = counters.get(name, 0) + n
+
+
+def stack():
+    if not hasattr(_frames, 'stack'):
+        _frames.stack = []
+    return _frames.stack
+
+
+"""Runs the body in scope, adding its wall time minus the time of nested
+   timed scopes to the scope's seconds
+"""
+class timing(object):
+    def __init__(self, scope):
+        self.scope = scope
+
+    def __enter__(self):
+        self.token = SCOPE.set(self.scope)
+        self.nested = [0.0]
+        stack().append(self.nested)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        stack().pop()
+        if stack():
+            stack()[-1][0] = stack()[-1][0] + elapsed
+        count('seconds', elapsed - self.nested[0])
+        SCOPE.reset(self.token)
+
+
+"""Wraps a stage's record stream: each record is produced in the stage's
+   scope, and the variant records (those with an INFO column) are counted
+"""
+def timed(scope, records):
+    iterator = iter(records)
+    while True:
+        with timing(scope):
+            try:
+                record = next(iterator)
+            except StopIteration:
+                return
+            if getattr(record, 'info', None) is not None:
+                count('records')
+        yield record
+
+
+"""Stage function whose record stream is wrapped by timed()
+"""
+def timedStage(scope, stage):
+    def run(records, **options):
+        return timed(scope, stage(records, **options))
+    return run
+
+
+"""Clears the counters; scopes lists the scopes to report first, in order
+"""
+def reset(scopes=()):
+    with _lock:
+        _counters.clear()
+        del _order[:]
+        for scope in scopes:
+            _counters[scope] = {}
+            _order.append(scope)
+
+
+"""Counters per scope, in the order the scopes were first seen
+"""
+def counters():
+    with _lock:
+        return [(scope, dict(_counters[scope])) for scope in _order]
+
+
+"""Adds counters collected in another process (e.g. a shard worker)
+"""
+def mergeCounters(other):
+    with _lock:
+        for scope, counters in other:
+            if scope not in _counters:
+                _counters[scope] = {}
+                _order.append(scope)
+            for name, value in counters.items():
+                _counters[scope][name] = _counters[scope].get(name, 0) + value
+
+
+def reportName(basefile):
+    return basefile + '.stats.json'
+
+
+"""Writes the counters of a run to <basefile>.stats.json
+"""
+def writeReport(basefile, mode, seconds):
+    stages = []
+    for scope, values in counters():
+        stage = {'stage': scope}
+        for name, value in sorted(values.items()):
+            stage[name] = round(value, 6) if isinstance(value, float) \
+                else value
+        stages.append(stage)
+
+    report = {'mode': mode, 'seconds': round(seconds, 6), 'stages': stages}
+    with open(reportName(basefile), 'w') as fh:
+        json.dump(report, fh, indent=2)
+        fh.write('\n')
+
+### EOF
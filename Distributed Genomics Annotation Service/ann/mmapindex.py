@@ -0,0 +1,333 @@
+# mmapindex.py
+#
+#
+# Memory-mapped position indexes of large reference tables
+#
+# dbSNP and the per-chromosome tfbsConsSites<N> tables are too large to
+# preload as Python objects. This module exports them offline, one
+# directory per table under INDEX_DIR, with for each chromosome:
+#
+#   <chrom>.start    sorted positions (or interval starts), int64
+#   <chrom>.end      interval ends in the same order (interval tables)
+#   <chrom>.offsets  offsets of each row in the payload file, int64
+#   <chrom>.payload  the rows, packed one after the other
+#
+# and a manifest.json with the columns, row counts and reference version.
+# Rows are streamed from the database in order of their start and written
+# as they arrive, so an export holds no table in memory. The files are
+# opened with mmap, so opening an index costs next to nothing and its
+# pages are shared by all worker processes; positions are resolved with a
+# binary search (bisect) over the mapped starts.
+#
+#   python mmapindex.py <index dir> [dbSNP] [tfbsConsSites]
+#
+##
+
+import os
+import sys
+import mmap
+import json
+import array
+import bisect
+import shutil
+import threading
+import reference as ref
+import statements as st
+
+# Directory holding the exported tables (empty = no mapped indexes)
+INDEX_DIR = ''
+
+# Rows fetched from the database at a time while exporting
+FETCH_SIZE = 100000
+
+# Layout of the exported files; exports of another format are not opened
+FORMAT = 2
+
+# Separates the columns of a packed row; None is stored as NULL
+SEPARATOR = '\x1f'
+NULL = '\\N'
+
+CHROM_QUERY = 'select distinct {chrom} from {table};'
+EXPORT_QUERY = 'select {columns} from {table} where {chrom}=%s ' + \
+    'order by {start};'
+EXPORT_SPLIT_QUERY = 'select {columns} from {table} order by {start};'
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+"""Chromosome key of the index files: as reference.chromKey, without a
+   chr prefix, so that '1' and 'chr1' tables share one naming
+"""
+def indexKey(chrom):
+    key = ref.chromKey(chrom)
+    return key[3:] if key.startswith('chr') else key
+
+
+def packRow(row):
+    return SEPARATOR.join([NULL if x is None else str(x)
+        for x in row]).encode()
+
+
+def unpackRow(data):
+    return [None if x == NULL else x
+        for x in data.decode().split(SEPARATOR)]
+
+
+def fetchRows(cursor):
+    while True:
+        batch = cursor.fetchmany(FETCH_SIZE)
+        if not batch:
+            return
+        for row in batch:
+            yield row
+
+
+"""Rows of one chromosome of a table in order of startCol: (names, rows),
+   rows streamed from cursor (an unbuffered SSCursor keeps the server from
+   sending the whole result at once)
+"""
+def exportRows(cursor, table, chrom, chromCol, columns, startCol):
+    if chromCol is None:
+        statement = st.prepare('mmapindex.export', EXPORT_SPLIT_QUERY,
+            columns=columns, table=table + chrom, start=startCol)
+        statement.execute(cursor)
+    else:
+        statement = st.prepare('mmapindex.export', EXPORT_QUERY,
+            columns=columns, table=table, chrom=chromCol, start=startCol)
+        statement.execute(cursor, (chrom,))
+
+    return [d[0] for d in cursor.description], fetchRows(cursor)
+
+
+"""int64 values appended to a file, FETCH_SIZE at a time
+"""
+class Int64File(object):
+    def __init__(self, filename):
+        self.fh = open(filename, 'wb')
+        self.values = array.array('q')
+
+    def append(self, value):
+        self.values.append(value)
+        if (len(self.values) >= FETCH_SIZE):
+            self.flush()
+
+    def flush(self):
+        self.values.tofile(self.fh)
+        self.values = array.array('q')
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+
+"""Writes the rows of one chromosome to the files at base as they arrive
+   (in order of their start); returns the number of rows and the length
+   of the longest interval
+"""
+def writeChromosome(base, names, rows, startCol, endCol, interval):
+    s, e = names.index(startCol), names.index(endCol)
+    starts = Int64File(base + '.start')
+    ends = Int64File(base + '.end') if interval else None
+    offsets = Int64File(base + '.offsets')
+    count = 0
+    offset = 0
+    maxLength = 0
+    last = None
+
+    offsets.append(0)
+    with open(base + '.payload', 'wb') as fh:
+        for row in rows:
+            start, end = int(row[s]), int(row[e])
+            if last is not None and start < last:
+                raise ValueError(f"mmapindex: rows of {base} are not " + \
+                    f"sorted by {startCol}")
+            last = start
+            data = packRow(row)
+            fh.write(data)
+            offset = offset + len(data)
+            starts.append(start)
+            if ends is not None:
+                ends.append(end)
+            offsets.append(offset)
+            maxLength = max(maxLength, end - start)
+            count = count + 1
+
+    for values in (starts, ends, offsets):
+        if values is not None:
+            values.close()
+    return count, maxLength
+
+
+"""Writes the index of table to <outdir>/<name>: rows of each chromosome
+   in order of startCol (ties in the order the database sorts them), with
+   the intervals' endCol if it differs. chromCol=None exports the
+   per-chromosome tables <table><chrom> for each of chroms
+"""
+def buildIndex(cursor, outdir, table, chromCol, startCol, endCol,
+    columns='*', chroms=None, name=None):
+
+    name = name or table
+    if chroms is None:
+        chroms = [str(row[0]) for row in st.prepare('mmapindex.chroms',
+            CHROM_QUERY, chrom=chromCol, table=table).fetchall(cursor)]
+
+    directory = os.path.join(outdir, name)
+    building = directory + '.tmp'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+
+    manifest = {'table': table, 'format': FORMAT,
+        'version': ref.REFERENCE_VERSION, 'columns': None,
+        'interval': startCol != endCol, 'chroms': {}}
+    for chrom in chroms:
+        names, rows = exportRows(cursor, table, chrom, chromCol, columns,
+            startCol)
+        manifest['columns'] = names
+
+        key = indexKey(chrom)
+        base = os.path.join(building, key)
+        count, maxLength = writeChromosome(base, names, rows, startCol,
+            endCol, manifest['interval'])
+        if (count == 0):
+            for ext in ('.start', '.end', '.offsets', '.payload'):
+                if os.path.exists(base + ext):
+                    os.unlink(base + ext)
+            continue
+
+        manifest['chroms'][key] = {'rows': count, 'maxLength': maxLength}
+        print(f"{name} {chrom}: {count} rows")
+
+    with open(os.path.join(building, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+        fh.write('\n')
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(building, directory)
+
+
+def mapFile(filename):
+    with open(filename, 'rb') as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+"""Files of one chromosome, mapped read-only
+"""
+class MappedChromosome(object):
+    def __init__(self, base, interval, maxLength):
+        self.starts = memoryview(mapFile(base + '.start')).cast('q')
+        self.ends = memoryview(mapFile(base + '.end')).cast('q') \
+            if interval else None
+        self.offsets = memoryview(mapFile(base + '.offsets')).cast('q')
+        self.maxLength = maxLength
+        self.payload = mapFile(base + '.payload')
+
+    def rows(self, indexes):
+        return [unpackRow(self.payload[self.offsets[i]:self.offsets[i + 1]])
+            for i in indexes]
+
+    def find(self, pos):
+        hi = bisect.bisect_right(self.starts, pos)
+        if self.ends is None:
+            return self.rows(range(bisect.bisect_left(self.starts, pos, 0,
+                hi), hi))
+
+        # Intervals holding pos start at most maxLength before it
+        lo = bisect.bisect_left(self.starts, pos - self.maxLength, 0, hi)
+        return self.rows([i for i in range(lo, hi) if self.ends[i] >= pos])
+
+
+"""Exported table opened from its directory
+   find(chrom, pos) returns the rows at pos (position tables) or whose
+   interval holds pos (interval tables), in order of their start;
+   findMany(chrom, positions) does the same for a batch of positions
+"""
+class MappedIndex(object):
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as fh:
+            self.manifest = json.load(fh)
+        self.format = self.manifest.get('format')
+        self.version = self.manifest['version']
+        self.columns = self.manifest['columns']
+        self.interval = self.manifest['interval']
+        self.chroms = {}
+        self.lock = threading.Lock()
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def chromosome(self, chrom):
+        key = indexKey(chrom)
+        with self.lock:
+            if key not in self.chroms:
+                info = self.manifest['chroms'].get(key)
+                self.chroms[key] = None if info is None else \
+                    MappedChromosome(os.path.join(self.directory, key),
+                    self.interval, info['maxLength'])
+            return self.chroms[key]
+
+    def find(self, chrom, pos):
+        return self.findMany(chrom, [pos])[0]
+
+    def findMany(self, chrom, positions):
+        mapped = self.chromosome(chrom)
+        if mapped is None:
+            return [[] for pos in positions]
+        return [mapped.find(int(pos)) for pos in positions]
+
+
+"""Index of table exported under INDEX_DIR for the current reference
+   version, opened once per process; None if there is none
+"""
+def openIndex(table):
+    if not INDEX_DIR:
+        return None
+    with _lock:
+        if table not in _indexes:
+            index = None
+            directory = os.path.join(INDEX_DIR, table)
+            if os.path.exists(os.path.join(directory, 'manifest.json')):
+                index = MappedIndex(directory)
+                if (index.format != FORMAT) or \
+                    (index.version != ref.REFERENCE_VERSION):
+                    index = None
+            _indexes[table] = index
+        return _indexes[table]
+
+
+"""Drops the opened indexes, e.g. after they were rebuilt
+"""
+def refresh():
+    with _lock:
+        _indexes.clear()
+
+
+def main(argv):
+    import pymysql
+    import utils as u
+    import annotate as ann
+
+    if not argv:
+        print("Usage: mmapindex.py <index dir> [dbSNP] [tfbsConsSites]")
+        return
+    outdir = argv[0]
+    tables = argv[1:] or ['dbSNP'] + [name for name, annotator
+        in ann.REGION_ANNOTATORS.items() if annotator.mapped]
+
+    conn = u.db_connect()
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    for table in tables:
+        if (table == 'dbSNP'):
+            buildIndex(cursor, outdir, 'dbSNP', 'CHR', 'POS', 'POS')
+        else:
+            annotator = ann.REGION_ANNOTATORS[table]
+            buildIndex(cursor, outdir, annotator.table, annotator.chromCol,
+                annotator.startCol, annotator.endCol,
+                columns=annotator.columns, chroms=annotator.chroms)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+### EOF
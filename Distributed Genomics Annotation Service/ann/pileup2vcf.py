@@ -11,29 +11,36 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
+import sys
 import datetime
-import file_utils as fu
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import annotate as ann
+import bgzf
+import instrument
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
-def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
+# Chromosome names accepted: ACCEPTED_CHR with or without chr prefix, and
+# M or chrM for MT; as a set of strings and as a set of bytes
+ACCEPTED_NAMES = frozenset(ACCEPTED_CHR + ['chr' + c for c in ACCEPTED_CHR] +
+    ['M', 'chrM'])
+ACCEPTED_BYTES = frozenset([name.encode() for name in ACCEPTED_NAMES])
+HETERO_BYTES = dict([(code.encode(), bases.encode())
+    for code, bases in HETERO.items()])
 
-    for l in lst:
-        l = str(l)
+# Bytes of pileup or VCF read (and converted by one worker) at a time
+BLOCK_BYTES = 1 << 22
 
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
 
-    return (int(depth) - (match_sum + ast))
+def count_alt(depth, bases):
+    """ Depth less the reads matching the reference (. and ,) and the
+        deletions (*) """
+    return int(depth) - (bases.count('.') + bases.count(',') + \
+        bases.count('*'))
 
 
 def vcfheader(pileup):
@@ -58,7 +65,7 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    if alt not in HETERO:
         return alt
     else:
         alt_x = HETERO[alt]
@@ -83,7 +90,7 @@ def varpileup_line2vcf_line(pileupfields):
     alt_count = str(count_alt(depth, pileupfields[8]))
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if alt in HETERO:
         GT = '0/1'
         alt = hetero2homo(ref,alt)
 
@@ -92,57 +99,192 @@ def varpileup_line2vcf_line(pileupfields):
         consqual + ':' + depth + ':' + alt_count
 
 
-def filter_pileup(pileup, outfile=None, chr_col=0, 
+def accepted(chr, ref, alt):
+    """ Whether a line is a variant (ALT != REF) on chromosomes 1 - 22, X, Y
+        or MT """
+    return (alt != ref) and (chr.strip() in ACCEPTED_NAMES)
+
+
+def accepted_bytes(fields, chr_col, ref_col, alt_col):
+    """ accepted() on the bytes columns of a line """
+    if (fields[alt_col] == fields[ref_col]):
+        return False
+    chr = fields[chr_col]
+    return (chr in ACCEPTED_BYTES) or (chr.strip() in ACCEPTED_BYTES)
+
+
+def convert_fields(fields):
+    """ varpileup_line2vcf_line on the bytes columns of a pileup line """
+    ref = fields[2]
+    alt = fields[3]
+    depth = fields[7]
+    bases = fields[8]
+    alt_count = int(depth) - (bases.count(b'.') + bases.count(b',') + \
+        bases.count(b'*'))
+
+    GT = b'1/1'
+    pair = HETERO_BYTES.get(alt)
+    if pair is not None:
+        GT = b'0/1'
+        alt = pair[1:2] if (ref == pair[:1]) else pair[:1]
+
+    return b'\t'.join((fields[0], fields[1], b'.', ref, alt, fields[6],
+        b'PASS', b'.', b'GT:GQ:DP:AD', GT + b':' + fields[4] + b':' + \
+        depth + b':' + str(alt_count).encode()))
+
+
+def convert_lines(block, chr_col=0, ref_col=2, alt_col=3, sep=b'\t',
+    filtered=True):
+    """ VCF lines (bytes, without newline) of the pileup lines in block that
+        filter_pileup keeps, or of all of them unless filtered """
+    lines = []
+    for line in block.split(b'\n'):
+        fields = line.strip().split(sep, 9)
+        if ((len(fields) >= 9) and ((not filtered) or \
+            accepted_bytes(fields, chr_col, ref_col, alt_col))):
+            lines.append(convert_fields(fields))
+    return lines
+
+
+def convert_block(block, chr_col=0, ref_col=2, alt_col=3, sep=b'\t'):
+    """ convert_lines as one block of newline-terminated lines """
+    lines = convert_lines(block, chr_col, ref_col, alt_col, sep)
+    return b'\n'.join(lines) + b'\n' if lines else b''
+
+
+def filter_block(block, chr_col=0, ref_col=3, alt_col=4, sep=b'\t'):
+    """ The header lines and the lines filter_vcf keeps of a block of VCF
+        lines, as one block """
+    lines = []
+    for line in block.split(b'\n'):
+        line = line.strip()
+        if line.startswith(b'#'):
+            lines.append(line)
+        else:
+            fields = line.split(sep, 8)
+            if ((len(fields) >= 8) and \
+                accepted_bytes(fields, chr_col, ref_col, alt_col)):
+                lines.append(line)
+    return b'\n'.join(lines) + b'\n' if lines else b''
+
+
+def read_blocks(fh, size=None):
+    """ Blocks of about size bytes (BLOCK_BYTES) of whole lines """
+    size = size or BLOCK_BYTES
+    while True:
+        block = fh.read(size)
+        if not block:
+            return
+        yield block + fh.readline()
+
+
+def map_blocks(function, blocks, workers=1, *args):
+    """ function(block, *args) of each block, in order; with workers > 1
+        the blocks are processed in a process pool, with at most two per
+        worker in flight """
+    if (workers <= 1):
+        for block in blocks:
+            yield function(block, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = collections.deque()
+        for block in blocks:
+            window.append(pool.submit(function, block, *args))
+            if (len(window) >= 2 * workers):
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def convert_pileup(pileup, outfile=None, header=True, workers=1, chr_col=0,
     ref_col=2, alt_col=3, sep='\t'):
-    
-    fh = open(pileup, "r")
+    """ High-throughput filter_pileup: the pileup (plain or gzip) is read
+        and converted as bytes, in blocks of BLOCK_BYTES, on workers
+        processes; the VCF (BGZF if outfile ends with .gz) is the same """
     if (outfile is None):
         outfile = pileup + '.vcf'
 
-    fu.delete(outfile)
-    fh_out = open(outfile, "w")
-    fh_out.write(vcfheader(pileup) + '\n')
+    with bgzf.openBinary(pileup) as fh, \
+        bgzf.openBinary(outfile, 'w') as fh_out:
+        if header:
+            fh_out.write((vcfheader(pileup) + '\n').encode())
+        for block in map_blocks(convert_block, read_blocks(fh), workers,
+            chr_col, ref_col, alt_col, sep.encode()):
+            fh_out.write(block)
 
 
-    for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
+def pileup_records(pileup, header=True, chr_col=0, ref_col=2, alt_col=3,
+    sep='\t'):
+    """ Streams a variant pileup file (plain or gzip) as VCF records, headed
+        by vcfheader() unless header is False (e.g. for a shard of the
+        file); every line is converted, the lines filter_pileup drops are
+        left to filter_stage """
+    if header:
+        for line in vcfheader(pileup).split('\n'):
+            yield ann.Record(line.split('\t'))
+
+    with bgzf.openBinary(pileup) as fh:
+        for block in read_blocks(fh):
+            instrument.count('bytes_read', len(block))
+            for line in convert_lines(block, chr_col, ref_col, alt_col,
+                sep.encode(), filtered=False):
+                yield ann.Record(line.decode().split('\t'))
+
+
+def filter_stage(records, log=None, chr_col=0, ref_col=3, alt_col=4):
+    """ Pre-stage dropping the records filter_vcf removes, before any
+        annotator looks them up; headers are passed through """
+    log = [] if log is None else log
+    kept = 0
+    dropped = 0
 
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
+    for record in records:
+        fields = record.fields
+        if ann.isHeader(fields):
+            yield record
+        elif ((len(fields) >= 8) and \
+            accepted(fields[chr_col], fields[ref_col], fields[alt_col])):
+            kept = kept + 1
+            yield record
+        else:
+            dropped = dropped + 1
+
+    log.append({'kind': 'filtered', 'variants': kept, 'dropped': dropped})
+
+
+def filter_pileup(pileup, outfile=None, chr_col=0, 
+    ref_col=2, alt_col=3, sep='\t'):
 
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+    convert_pileup(pileup, outfile, chr_col=chr_col, ref_col=ref_col,
+        alt_col=alt_col, sep=sep)
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
+   (with or without chr prefix)
 """
 def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3, 
-    alt_col=4, sep='\t'):
+    alt_col=4, sep='\t', workers=1):
 
-    fh = open(pileup, "r")
     if (outfile is None):
         outfile = pileup + '.filt'
 
-    fu.delete(outfile)
-    fh_out = open(outfile, "w")
+    with bgzf.openBinary(pileup) as fh, \
+        bgzf.openBinary(outfile, 'w') as fh_out:
+        for block in map_blocks(filter_block, read_blocks(fh), workers,
+            chr_col, ref_col, alt_col, sep.encode()):
+            fh_out.write(block)
 
 
-    for line in fh:
-        line = line.strip()
-        if line.startswith('#'):
-            fh_out.write(str(line)+'\n')
-        else:
-            fields = line.split(sep)
-            if (len(fields) >= 8):
-                chr = str(fields[chr_col])
-                ref = str(fields[ref_col])
-                alt = str(fields[alt_col])
-
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-                    fh_out.write(str(line) + '\n')
+def main(argv):
+    if not argv:
+        print("Usage: pileup2vcf.py <pileup> [<vcf>] [workers]")
+        return
+    convert_pileup(argv[0], argv[1] if len(argv) > 1 else None,
+        workers=int(argv[2]) if len(argv) > 2 else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,183 @@
+# reference.py
+#
+#
+# In-memory indexes of small reference tables, loaded once per worker
+# process so that overlap lookups do not need a database round trip
+#
+##
+
+import time
+import threading
+import statements as st
+
+# Tables with more rows than this are never preloaded
+PRELOAD_MAX_ROWS = 1000000
+
+# Seconds before a preloaded table is reloaded (0 = keep until refresh())
+PRELOAD_MAX_AGE = 0
+
+# Assembly/release of the reference database, used to tell apart caches
+# built from different releases
+REFERENCE_VERSION = 'hg19'
+
+# Width of the position buckets used by IntervalIndex
+BUCKET_SIZE = 100000
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+"""Chromosome names compare the way MySQL compares them: case-insensitive
+"""
+def chromKey(chrom):
+    return str(chrom).strip().lower()
+
+
+"""Per-chromosome index of [start, end] intervals
+   Intervals are registered in every fixed-size bucket they overlap, so a
+   point lookup scans only one bucket. Matches are returned in load order,
+   which is the order the database returns them for the equivalent query
+"""
+class IntervalIndex(object):
+    def __init__(self, bucket_size=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        self.rows = 0
+
+    def add(self, chrom, start, end, row):
+        chrom_buckets = self.buckets.setdefault(chromKey(chrom), {})
+        entry = (start, end, row)
+        for b in range(start // self.bucket_size, end // self.bucket_size + 1):
+            chrom_buckets.setdefault(b, []).append(entry)
+        self.rows = self.rows + 1
+
+    def find(self, chrom, pos):
+        chrom_buckets = self.buckets.get(chromKey(chrom))
+        if chrom_buckets is None:
+            return []
+        bucket = chrom_buckets.get(pos // self.bucket_size, [])
+        return [row for (start, end, row) in bucket if start <= pos <= end]
+
+
+"""Hash index on (chromosome, exact position column)
+"""
+class PositionIndex(object):
+    def __init__(self):
+        self.positions = {}
+        self.rows = 0
+
+    def add(self, chrom, pos, row):
+        self.positions.setdefault((chromKey(chrom), pos), []).append(row)
+        self.rows = self.rows + 1
+
+    def find(self, chrom, pos):
+        return self.positions.get((chromKey(chrom), pos), [])
+
+
+"""Loads all rows of a table and returns them with the column names
+"""
+def loadTable(cursor, table):
+    rows = st.prepare('reference.load', 'select * from {table};',
+        table=table).fetchall(cursor)
+    names = [d[0] for d in cursor.description]
+    return names, rows
+
+
+def countRows(cursor, table):
+    return int(st.prepare('reference.count', 'select count(*) from {table};',
+        table=table).fetchone(cursor)[0])
+
+
+"""Returns the index cached under key, building it on first use
+   Returns None when the tables hold more than PRELOAD_MAX_ROWS rows (as
+   counted by count), in which case the caller should keep querying the
+   database
+"""
+def cachedIndex(key, count, build):
+    with _lock:
+        cached = _indexes.get(key)
+        if cached is not None:
+            index, loaded = cached
+            if not PRELOAD_MAX_AGE or (time.time() - loaded) < PRELOAD_MAX_AGE:
+                return index
+
+        index = None
+        if count() <= PRELOAD_MAX_ROWS:
+            index = build()
+        _indexes[key] = (index, time.time())
+        return index
+
+
+"""Returns a cached index for table, building it on first use (or None,
+   see cachedIndex)
+"""
+def getIndex(cursor, table, build):
+    return cachedIndex(table, lambda: countRows(cursor, table),
+        lambda: build(*loadTable(cursor, table)))
+
+
+"""Interval index over the rows of table where start <= pos <= end
+"""
+def getIntervalIndex(cursor, table, chromCol='chrom', startCol='chromStart',
+    endCol='chromEnd'):
+
+    def build(names, rows):
+        c, s, e = names.index(chromCol), names.index(startCol), \
+            names.index(endCol)
+        index = IntervalIndex()
+        for row in rows:
+            index.add(row[c], int(row[s]), int(row[e]), row)
+        return index
+
+    return getIndex(cursor, table, build)
+
+
+"""One interval index over the rows of several tables with the same
+   interval columns; each row is held as (position of its table in
+   tables, row)
+"""
+def getMergedIntervalIndex(cursor, tables, chromCol='chrom',
+    startCol='chromStart', endCol='chromEnd'):
+
+    def build():
+        index = IntervalIndex()
+        for t, table in enumerate(tables):
+            names, rows = loadTable(cursor, table)
+            c, s, e = names.index(chromCol), names.index(startCol), \
+                names.index(endCol)
+            for row in rows:
+                index.add(row[c], int(row[s]), int(row[e]), (t, row))
+        return index
+
+    return cachedIndex(tuple(tables), lambda: sum([countRows(cursor, table)
+        for table in tables]), build)
+
+
+"""Hash index over the rows of table where posCol = pos
+"""
+def getPositionIndex(cursor, table, chromCol='chrom', posCol='chromEnd'):
+
+    def build(names, rows):
+        c, p = names.index(chromCol), names.index(posCol)
+        index = PositionIndex()
+        for row in rows:
+            index.add(row[c], int(row[p]), row)
+        return index
+
+    return getIndex(cursor, table, build)
+
+
+"""Refresh hook for reference database updates: drops the cached indexes
+   of table (or of every table) so that they are reloaded on next use
+"""
+def refresh(table=None):
+    with _lock:
+        if table is None:
+            _indexes.clear()
+        else:
+            for key in list(_indexes):
+                if (key == table) or (isinstance(key, tuple) and
+                    table in key):
+                    del _indexes[key]
+
+### EOF
@@ -8,6 +8,16 @@
 import sys
 import time
 import driver
+import instrument
+import aiolookup
+import mmapindex
+import bgzf
+import checkpoint
+import reference
+import statements
+import transcripts
+import utils
+import varcache
 import boto3, os, json
 from configparser import ConfigParser
 from datetime import datetime
@@ -32,12 +42,58 @@ class Timer(object):
 if __name__ == '__main__':
   # Call the AnnTools pipeline
   if len(sys.argv) > 1:
-    with Timer():
-      driver.run(sys.argv[1], 'vcf')
-
     config = ConfigParser(os.environ)
     config.read('ann_config.ini')  
 
+    reference.PRELOAD_MAX_ROWS = config.getint('ann', 'PreloadMaxRows',
+      fallback=reference.PRELOAD_MAX_ROWS)
+    reference.PRELOAD_MAX_AGE = config.getint('ann', 'PreloadMaxAge',
+      fallback=reference.PRELOAD_MAX_AGE)
+    transcripts.TRANSCRIPT_CACHE_DIR = config.get('ann', 'TranscriptCacheDir',
+      fallback=transcripts.TRANSCRIPT_CACHE_DIR)
+    reference.REFERENCE_VERSION = config.get('ann', 'ReferenceVersion',
+      fallback=reference.REFERENCE_VERSION)
+    varcache.CACHE_PATH = config.get('ann', 'VariantCachePath',
+      fallback=varcache.CACHE_PATH)
+    varcache.CACHE_MAX_ENTRIES = config.getint('ann', 'VariantCacheMaxEntries',
+      fallback=varcache.CACHE_MAX_ENTRIES)
+    mmapindex.INDEX_DIR = config.get('ann', 'PositionIndexDir',
+      fallback=mmapindex.INDEX_DIR)
+    aiolookup.QUERY_CONCURRENCY = config.getint('ann', 'QueryConcurrency',
+      fallback=aiolookup.QUERY_CONCURRENCY)
+    aiolookup.QUERY_DRIVER = config.get('ann', 'QueryDriver',
+      fallback=aiolookup.QUERY_DRIVER)
+    driver.COMPRESS_OUTPUT = config.getboolean('ann', 'CompressOutput',
+      fallback=driver.COMPRESS_OUTPUT)
+    driver.FILTER_VARIANTS = config.getboolean('ann', 'FilterVariants',
+      fallback=driver.FILTER_VARIANTS)
+    bgzf.COMPRESS_THREADS = config.getint('ann', 'CompressThreads',
+      fallback=bgzf.COMPRESS_THREADS)
+    checkpoint.CHECKPOINT_LINES = config.getint('ann', 'CheckpointLines',
+      fallback=checkpoint.CHECKPOINT_LINES)
+    if config.getboolean('ann', 'CheckpointToS3', fallback=False) and \
+      len(sys.argv) > 3:
+      # Completed stages of the job, so that it can resume on another host
+      checkpoint.STORE = checkpoint.S3Store(config['s3']['OutputsBucket'],
+        config['s3']['KeyPrefix'] + sys.argv[2] + '/checkpoints/' + \
+        sys.argv[3] + '/', region_name=config['aws']['AwsRegionName'])
+
+    overrides = {
+      'dbSNP': {'batch_size': config.getint('ann', 'DbSnpBatchSize', fallback=1000)}
+    }
+
+    with Timer():
+      driver.run(sys.argv[1], driver.inputFormat(sys.argv[1]),
+        mode=config.get('ann', 'PipelineMode', fallback='staged'),
+        overrides=overrides,
+        workers=(config.getint('ann', 'Workers', fallback=0) or None),
+        shard_size=config.getint('ann', 'ShardSize', fallback=0),
+        sweep=config.getboolean('ann', 'SweepJoin', fallback=False),
+        checkpoints=config.getboolean('ann', 'Checkpoints', fallback=False))
+    print(f"Reference DB connection pool: {utils.db_pool_stats()}")
+    for line in statements.formatStats():
+      print(f"Query {line}")
+
     s3 = boto3.resource('s3', region_name = config['aws']['AwsRegionName'])
 
     input_file_path = sys.argv[1].split('/')
@@ -54,12 +110,15 @@ if __name__ == '__main__':
 
     files_to_upload.append(log_file)
 
-    parts = input_file.split('.')
-    annot_file = parts[0] + '.annot.' + parts[1]
+    annot_file = driver.annotatedName(input_file)
     annot_file = USER_DIR + annot_file
 
     files_to_upload.append(annot_file)
 
+    # Per-annotator timings and counters of the run (after the log and the
+    # annotated file, whose keys are recorded in DynamoDB below)
+    files_to_upload.append(instrument.reportName(USER_DIR + input_file))
+
     my_list = []
 
     for file in files_to_upload:
@@ -113,6 +172,6 @@ if __name__ == '__main__':
       print(f"{e}")
 
   else:
-    print("A valid .vcf file must be provided as input to this program.")
+    print("A valid .vcf or .pileup file must be provided as input to this program.")
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,155 @@
+# statements.py
+#
+#
+# Parameterized statements for the reference database queries
+#
+# Each query is defined once, with table and column names filled in when
+# the statement is prepared and every value passed as a parameter (%s), so
+# values never need quoting or escaping. Statements are cached by their
+# text, and the time spent executing and fetching each named statement is
+# counted.
+#
+##
+
+import re
+import time
+import threading
+import instrument
+
+# Table or column name, a comma-separated list of them, or *
+_NAME = r'[A-Za-z_][A-Za-z0-9_]*'
+_IDENTIFIER = re.compile(r'^(\*|' + _NAME + r'(\s*,\s*' + _NAME + r')*)$')
+
+_statements = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+"""One parameterized query; execute/fetchall/fetchone take the values of
+   its %s placeholders and record the elapsed time under the statement name
+"""
+class Statement(object):
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+    def run(self, cursor, params, fetch):
+        start = time.perf_counter()
+        cursor.execute(self.sql, tuple(params))
+        result = fetch(cursor)
+        record(self.name, time.perf_counter() - start, rowCount(result))
+        return result
+
+    def execute(self, cursor, params=()):
+        return self.run(cursor, params, lambda cursor: None)
+
+    def fetchall(self, cursor, params=()):
+        return self.run(cursor, params, lambda cursor: cursor.fetchall())
+
+    def fetchone(self, cursor, params=()):
+        return self.run(cursor, params, lambda cursor: cursor.fetchone())
+
+    """Same statement with qmark (?) placeholders, for DB-API drivers such
+       as sqlite3 used as a local stand-in for MySQL
+    """
+    def qmark(self):
+        return prepare(self.name, self.sql.replace('%s', '?'))
+
+
+"""Returns the statement for template, with {name} fields replaced by the
+   given table/column identifiers (which are validated, as they cannot be
+   passed as parameters)
+"""
+def prepare(name, template, **identifiers):
+    key = (name, template, tuple(sorted(identifiers.items())))
+    statement = _statements.get(key)
+    if statement is None:
+        for value in identifiers.values():
+            if not _IDENTIFIER.match(str(value)):
+                raise ValueError(f"prepare: invalid identifier {value!r} " + \
+                    f"in {name}")
+        sql = template.format(**identifiers) if identifiers else template
+        statement = _statements.setdefault(key, Statement(name, sql))
+    return statement
+
+
+"""Comma-separated placeholders for an IN list of n values
+"""
+def placeholders(n):
+    return ','.join(['%s'] * n)
+
+
+"""Pads values to the next power of two by repeating the last one, so that
+   IN lists of varying length map to a handful of statements
+"""
+def padded(values):
+    values = list(values)
+    size = 1
+    while (size < len(values)):
+        size = size * 2
+    return values + values[-1:] * (size - len(values))
+
+
+def rowCount(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple)) and \
+        (len(result) == 0 or isinstance(result[0], (list, tuple))):
+        return len(result)
+    return 1
+
+
+"""Counts one execution of statement name, also against the stage being
+   instrumented
+"""
+def record(name, seconds, rows=0):
+    instrument.count('statements')
+    instrument.count('rows', rows)
+    instrument.count('sql_seconds', seconds)
+    with _lock:
+        stats = _stats.setdefault(name, {'calls': 0, 'seconds': 0.0,
+            'max': 0.0})
+        stats['calls'] = stats['calls'] + 1
+        stats['seconds'] = stats['seconds'] + seconds
+        stats['max'] = max(stats['max'], seconds)
+
+
+"""Latency counters per statement name: calls, total seconds and the
+   slowest call
+"""
+def stats():
+    with _lock:
+        return dict((name, dict(counters))
+            for name, counters in _stats.items())
+
+
+def resetStats():
+    with _lock:
+        _stats.clear()
+
+
+"""Adds counters collected in another process (e.g. a shard worker)
+"""
+def mergeStats(other):
+    with _lock:
+        for name, counters in other.items():
+            stats = _stats.setdefault(name, {'calls': 0, 'seconds': 0.0,
+                'max': 0.0})
+            stats['calls'] = stats['calls'] + counters['calls']
+            stats['seconds'] = stats['seconds'] + counters['seconds']
+            stats['max'] = max(stats['max'], counters['max'])
+
+
+"""One line per statement, slowest total first
+"""
+def formatStats(counters=None):
+    counters = stats() if counters is None else counters
+    lines = []
+    for name, c in sorted(counters.items(),
+        key=lambda item: -item[1]['seconds']):
+        mean = (c['seconds'] / c['calls']) * 1000 if c['calls'] else 0.0
+        lines.append(f"{name}: {c['calls']} calls, {c['seconds']:.3f}s " + \
+            f"total, {mean:.2f}ms mean, {c['max'] * 1000:.2f}ms max")
+    return lines
+
+### EOF
@@ -0,0 +1,98 @@
+# sweep.py
+#
+#
+# Sorted sweep-join of VCF positions against a reference table
+#
+##
+
+import statements as st
+
+# Width of the chromStart windows in which a table is streamed
+SWEEP_WINDOW = 1000000
+
+SWEEP_QUERY = 'select {columns} from {table} where {start} >= %s AND ' + \
+    '{start} < %s order by {start};'
+
+SWEEP_CHROM_QUERY = 'select {columns} from {table} where {chrom}=%s AND ' + \
+    '{start} >= %s AND {start} < %s order by {start};'
+
+
+"""Merge-joins ascending positions against the intervals of a table
+   Instead of one point query per variant, the table is read once per
+   chromosome in chromStart order, one SWEEP_WINDOW-wide window at a time,
+   and only the intervals that can still overlap upcoming positions are
+   kept in memory. Overlapping rows are returned in chromStart order.
+
+   Positions are expected to be sorted within a chromosome (as in a sorted
+   VCF); a position lower than the previous one restarts the sweep of that
+   chromosome, so unsorted input stays correct but loses the benefit.
+
+   table may be a function of the chromosome for tables split per
+   chromosome, in which case chromCol is None; columns selects the row
+   layout (it must include startCol and endCol)
+"""
+class SweepJoin(object):
+    def __init__(self, cursor, table, chromCol='chrom', startCol='chromStart',
+        endCol='chromEnd', columns='*', window=SWEEP_WINDOW):
+
+        self.cursor = cursor
+        self.table = table
+        self.chromCol = chromCol
+        self.startCol = startCol
+        self.endCol = endCol
+        self.columns = columns
+        self.window = window
+        self.chrom = None
+        self.pos = None
+        self.queries = 0
+
+    def restart(self, chrom):
+        self.chrom = chrom
+        self.next_window = 0
+        self.pending = []
+        self.next_pending = 0
+        self.active = []
+
+    def fetchUpTo(self, pos):
+        # One query covers every window not yet read up to the one holding
+        # pos, so long gaps between variants cost a single round trip
+        lo = self.next_window * self.window
+        self.next_window = (pos // self.window) + 1
+        hi = self.next_window * self.window
+        table = self.table(self.chrom) if callable(self.table) else self.table
+
+        if self.chromCol is not None:
+            statement = st.prepare('sweep.' + table, SWEEP_CHROM_QUERY,
+                columns=self.columns, table=table, chrom=self.chromCol,
+                start=self.startCol)
+            rows = statement.fetchall(self.cursor, (str(self.chrom), lo, hi))
+        else:
+            statement = st.prepare('sweep.' + table, SWEEP_QUERY,
+                columns=self.columns, table=table, start=self.startCol)
+            rows = statement.fetchall(self.cursor, (lo, hi))
+        self.queries = self.queries + 1
+
+        names = [d[0] for d in self.cursor.description]
+        s, e = names.index(self.startCol), names.index(self.endCol)
+        self.pending = self.pending[self.next_pending:] + \
+            [(int(row[s]), int(row[e]), row) for row in rows]
+        self.next_pending = 0
+
+    def find(self, chrom, pos):
+        if (chrom != self.chrom) or (pos < self.pos):
+            self.restart(chrom)
+        self.pos = pos
+
+        if self.next_window * self.window <= pos:
+            self.fetchUpTo(pos)
+
+        pending = self.pending
+        while self.next_pending < len(pending) and \
+            pending[self.next_pending][0] <= pos:
+            self.active.append(pending[self.next_pending])
+            self.next_pending = self.next_pending + 1
+
+        self.active = [entry for entry in self.active if entry[1] >= pos]
+        return [row for (start, end, row) in self.active]
+
+### EOF
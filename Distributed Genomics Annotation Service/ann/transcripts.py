@@ -0,0 +1,131 @@
+# transcripts.py
+#
+#
+# Cache of parsed refGene transcript models (exon coordinate arrays), with
+# exon lookup by binary search. The cache can be persisted to disk per
+# reference version so that new workers start with it already filled.
+#
+##
+
+import os
+import bisect
+import pickle
+import threading
+import reference as ref
+
+# Directory of the persisted cache ('' = keep it in memory only)
+TRANSCRIPT_CACHE_DIR = ''
+
+_transcripts = {}
+_loaded = set()
+_added = 0
+_lock = threading.Lock()
+
+
+"""Exon coordinates of one transcript, sorted by exon start
+   max_ends[i] is the largest end among exons 0..i, which bounds the
+   backward scan in exonsAt even if exons were to overlap
+"""
+class Transcript(object):
+    __slots__ = ['starts', 'ends', 'max_ends']
+
+    def __init__(self, exonCount, exonStarts, exonEnds):
+        if isinstance(exonStarts, bytes):
+            exonStarts = exonStarts.decode('utf-8')
+        if isinstance(exonEnds, bytes):
+            exonEnds = exonEnds.decode('utf-8')
+
+        exonsSt = exonStarts.split(',')
+        exonsEn = exonEnds.split(',')
+        exons = sorted([(int(exonsSt[e]), int(exonsEn[e]), e)
+            for e in range(0, exonCount)])
+
+        self.starts = [start for (start, end, e) in exons]
+        self.ends = [(end, e) for (start, end, e) in exons]
+        self.max_ends = []
+        max_end = None
+        for (end, e) in self.ends:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    """Indices (in refGene order) of the exons with start <= pos <= end
+    """
+    def exonsAt(self, pos):
+        found = []
+        i = bisect.bisect_right(self.starts, pos) - 1
+        while (i >= 0) and (self.max_ends[i] >= pos):
+            end, e = self.ends[i]
+            if (end >= pos):
+                found.append(e)
+            i = i - 1
+        return sorted(found)
+
+
+def cacheFile(version=None):
+    return os.path.join(TRANSCRIPT_CACHE_DIR,
+        'transcripts.' + (version or ref.REFERENCE_VERSION) + '.pickle')
+
+
+"""Merges the persisted cache of the current reference version, once
+"""
+def load():
+    global _transcripts
+    version = ref.REFERENCE_VERSION
+    if not TRANSCRIPT_CACHE_DIR or version in _loaded:
+        return
+    _loaded.add(version)
+
+    try:
+        with open(cacheFile(version), 'rb') as f:
+            stored = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return
+
+    stored.update(_transcripts)
+    _transcripts = stored
+
+
+"""Writes the cache to disk if transcripts were added since the last save
+   The file on disk is merged in first so that concurrent workers do not
+   drop each other's entries, and replaced atomically
+"""
+def save():
+    global _added
+    with _lock:
+        if not TRANSCRIPT_CACHE_DIR or not _added:
+            return
+
+        try:
+            with open(cacheFile(), 'rb') as f:
+                stored = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            stored = {}
+        stored.update(_transcripts)
+
+        os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+        tmp = cacheFile() + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cacheFile())
+        _added = 0
+
+
+"""Returns the parsed transcript model of a refGene row
+   Transcript names are not unique across loci, so the key also holds the
+   chromosome and transcript coordinates
+"""
+def getTranscript(row):
+    global _added
+    key = (str(row[1]), str(row[2]), int(row[4]), int(row[5]))
+    transcript = _transcripts.get(key)
+    if transcript is None:
+        with _lock:
+            load()
+            transcript = _transcripts.get(key)
+            if transcript is None:
+                transcript = Transcript(int(row[8]), row[9], row[10])
+                _transcripts[key] = transcript
+                _added = _added + 1
+    return transcript
+
+### EOF
@@ -13,25 +13,58 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import itertools
+import threading
+import time
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Seconds the RDS secret is reused before it is fetched again
+DB_SECRET_TTL = 300
+
+# Idle connections kept open for reuse by later callers in this process
+DB_POOL_MAX_IDLE = 16
+
+# Function returning a new DB-API connection to use instead of the RDS
+# reference database (e.g. a local fixture); None = RDS
+DB_CONNECT = None
+
+_db_secret = None
+_db_secret_time = 0
+_db_secret_lock = threading.Lock()
+
+
+"""Get reference database credentials from AWS Secrets Manager
+   The secret is cached for DB_SECRET_TTL seconds; refresh=True forces a
+   new fetch (e.g. after the credentials have been rotated)
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+def get_db_secret(refresh=False):
+    global _db_secret, _db_secret_time
+
+    with _db_secret_lock:
+        if (refresh or _db_secret is None or
+            (time.time() - _db_secret_time) > DB_SECRET_TTL):
+
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _db_secret = json.loads(asm_response['SecretString'])
+                _db_secret_time = time.time()
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+        return _db_secret
 
+
+"""Open a new connection to the reference database
+"""
+def db_open(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -39,7 +72,6 @@ def db_connect():
     password = rds_secret['password']
     database_name = 'annotator'
 
-    # Return a connection to the database
     return pymysql.connect(
         host=rds_host,
         port=mysql_port,
@@ -48,6 +80,117 @@ def db_connect():
         db=database_name)
 
 
+"""Process-wide pool of reference database connections
+   Connections handed back by close() are kept for reuse and pinged before
+   being handed out again; dead ones are replaced transparently
+"""
+class ConnectionPool(object):
+    def __init__(self, max_idle=DB_POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self.reset()
+
+    """Starts over with no connections; in a forked child (shard or branch
+       worker) the idle connections of the parent share their sockets with
+       it, so they are dropped without being closed, which would end the
+       parent's sessions
+    """
+    def reset(self):
+        self.idle = []
+        self.lock = threading.Lock()
+        self.counters = {'created': 0, 'reused': 0, 'discarded': 0,
+            'in_use': 0, 'peak_in_use': 0}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters[name] + n
+
+    def acquire(self):
+        conn = None
+        with self.lock:
+            while self.idle and conn is None:
+                conn = self.idle.pop()
+                try:
+                    conn.ping(reconnect=True)
+                    self.count('reused')
+                except Exception:
+                    self.count('discarded')
+                    conn = None
+
+        if conn is None:
+            if DB_CONNECT is not None:
+                conn = DB_CONNECT()
+            else:
+                try:
+                    conn = db_open(get_db_secret())
+                except pymysql.err.OperationalError:
+                    # Credentials may have been rotated since they were cached
+                    conn = db_open(get_db_secret(refresh=True))
+            with self.lock:
+                self.count('created')
+
+        with self.lock:
+            self.count('in_use')
+            self.counters['peak_in_use'] = max(self.counters['peak_in_use'],
+                self.counters['in_use'])
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.count('in_use', -1)
+            if len(self.idle) < self.max_idle:
+                try:
+                    # Do not carry a read snapshot over to the next user
+                    conn.rollback()
+                    self.idle.append(conn)
+                    return
+                except Exception:
+                    self.count('discarded')
+
+        conn.close()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, idle=len(self.idle))
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+"""Connection handed out by the pool; close() returns it to the pool
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+_db_pool = ConnectionPool()
+os.register_at_fork(after_in_child=_db_pool.reset)
+
+
+"""Get connection to reference database
+"""
+def db_connect():
+    return PooledConnection(_db_pool, _db_pool.acquire())
+
+
+"""Pool usage counters: connections created, reused, discarded,
+   in use now, peak in use, and idle
+"""
+def db_pool_stats():
+    return _db_pool.stats()
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
@@ -108,6 +251,17 @@ def dedup(mylist):
     return outlist
 
 
+"""Splits an iterable into consecutive lists of at most size elements
+"""
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 """Helper method to parse fields
 """
 def parse_field(text, key, sep1, sep2):
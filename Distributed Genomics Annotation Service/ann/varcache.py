@@ -0,0 +1,151 @@
+# varcache.py
+#
+#
+# Persistent cross-job cache of per-variant reference lookups
+#
+# Each annotator's database lookup for a variant is stored under a
+# content-addressed key: a digest of (reference version, annotator,
+# chromosome, position, ref, alt). Later jobs, of any user, that see the
+# same variant skip the database. The cache is a local SQLite file shared
+# by all worker processes, bounded by CACHE_MAX_ENTRIES with least recently
+# used entries evicted first.
+#
+##
+
+import os
+import time
+import pickle
+import hashlib
+import sqlite3
+import reference as ref
+import instrument
+
+# SQLite file of the cache ('' = cache disabled)
+CACHE_PATH = ''
+
+# Entries kept before least recently used ones are evicted
+CACHE_MAX_ENTRIES = 1000000
+
+# Pending writes are flushed to the cache file in batches of this size
+CACHE_FLUSH_SIZE = 1000
+
+MISS = object()
+
+
+def openCache(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('PRAGMA journal_mode=WAL;')
+    db.execute('CREATE TABLE IF NOT EXISTS variants (key BLOB PRIMARY KEY, ' + \
+        'rows BLOB, used REAL);')
+    db.execute('CREATE INDEX IF NOT EXISTS variants_used ON variants (used);')
+    db.commit()
+    return db
+
+
+"""Lookup cache of one annotator
+   fetchall/fetchone run the given query only on a cache miss; with
+   CACHE_PATH unset they always query the database. close() writes the
+   pending entries, evicts beyond CACHE_MAX_ENTRIES and adds the hit/miss
+   counts to the stage log
+"""
+class VariantCache(object):
+    def __init__(self, annotator, path=None):
+        self.annotator = str(annotator)
+        self.path = CACHE_PATH if path is None else path
+        self.db = openCache(self.path) if self.path else None
+        self.hits = 0
+        self.misses = 0
+        self.pending = {}
+        self.touched = set()
+
+    def key(self, chrom, pos, ref_allele='', alt_allele=''):
+        text = '\t'.join([ref.REFERENCE_VERSION, self.annotator,
+            str(chrom), str(pos), str(ref_allele).upper(),
+            str(alt_allele).upper()])
+        return hashlib.sha1(text.encode('utf-8')).digest()
+
+    def get(self, key):
+        if key in self.pending:
+            value = self.pending[key]
+        else:
+            found = self.db.execute('SELECT rows FROM variants WHERE key = ?;',
+                (key,)).fetchone()
+            if found is None:
+                self.misses = self.misses + 1
+                instrument.count('cache_misses')
+                return MISS
+            value = pickle.loads(found[0])
+            self.touched.add(key)
+        self.hits = self.hits + 1
+        instrument.count('cache_hits')
+        return value
+
+    def put(self, key, value):
+        self.pending[key] = value
+        if (len(self.pending) + len(self.touched) >= CACHE_FLUSH_SIZE):
+            self.flush()
+
+    def fetch(self, cursor, statement, params, one, variant):
+        fetch = statement.fetchone if one else statement.fetchall
+        if self.db is None:
+            return fetch(cursor, params)
+
+        key = self.key(*variant)
+        value = self.get(key)
+        if value is MISS:
+            value = fetch(cursor, params)
+            self.put(key, value)
+        return value
+
+    """statement.fetchall(cursor, params), or the cached rows of variant
+       (chrom, pos[, ref[, alt]])
+    """
+    def fetchall(self, cursor, statement, params, *variant):
+        return self.fetch(cursor, statement, params, False, variant)
+
+    def fetchone(self, cursor, statement, params, *variant):
+        return self.fetch(cursor, statement, params, True, variant)
+
+    def flush(self):
+        if self.db is None:
+            return
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO variants ' + \
+                '(key, rows, used) VALUES (?, ?, ?);',
+                [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                now) for key, value in self.pending.items()])
+            self.db.executemany('UPDATE variants SET used = ? WHERE key = ?;',
+                [(now, key) for key in self.touched])
+        self.pending = {}
+        self.touched = set()
+
+    def evict(self):
+        with self.db:
+            count = self.db.execute('SELECT count(*) FROM variants;').fetchone()[0]
+            if (count > CACHE_MAX_ENTRIES):
+                self.db.execute('DELETE FROM variants WHERE key IN ' + \
+                    '(SELECT key FROM variants ORDER BY used LIMIT ?);',
+                    (count - CACHE_MAX_ENTRIES,))
+
+    def close(self, log=None):
+        if self.db is None:
+            return
+        self.flush()
+        self.evict()
+        self.db.close()
+        self.db = None
+        if log is not None:
+            log.append(cacheCounts(self.annotator, self.hits, self.misses))
+
+
+"""Cache counters of one annotator, reported in the .count.log
+"""
+def cacheCounts(annotator, hits, misses):
+    return {'kind': 'cache', 'table': annotator, 'hits': hits,
+        'misses': misses}
+
+### EOF